@@ -8,6 +8,7 @@ from .utils import SScratchVar, Swap, Nop
 
 
 class Solution(Base):
+    READER_INT_SWAR = True
     work_ints: Final[AccountStateValue] = ReservedAccountStateValue(
         stack_type=TealType.uint64, max_keys=4
     )
@@ -5,9 +5,12 @@ from beaker.consts import TRUE
 
 from .base import Base
 from .utils import (
+    BoxArray,
     BoxArrayStruct,
     BoxScratchStore,
     Forever,
+    Int8,
+    Int16,
     SScratchVar,
     BoxAllocator,
     Swap,
@@ -15,29 +18,28 @@ from .utils import (
 
 MAX_ITEMS = 50
 MAX_MONKEYS = 10
-
-
-class Item:
-    value = Int
-    monkey = Int
+# Brent window past which an item with no cycle yet goes back to lockstep rounds
+MAX_POWER = 512
 
 
 class Monkey:
     cnt = Int
+    size = Int  # Items held
     op = Bytes, 1
-    arg = Int
-    test = Int
-    if_true = Int
-    if_false = Int
+    arg = Int16
+    test = Int8
+    if_true = Int8
+    if_false = Int8
 
 
 class Solution(Base):
     work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=1)
 
     def work_box_size(self):
-        return 8 * 6 + 2 * (
-            MAX_ITEMS * BoxArrayStruct.element_size(Item)
-            + MAX_MONKEYS * BoxArrayStruct.element_size(Monkey)
+        return (
+            8 * 13
+            + 3 * MAX_MONKEYS * 8
+            + 2 * MAX_MONKEYS * (MAX_ITEMS * 8 + BoxArrayStruct.element_size(Monkey))
         )
 
     def flush(self, state: dict, cached):
@@ -55,17 +57,252 @@ class Solution(Base):
             round := SScratchVar(TealType.uint64),
             turn := SScratchVar(TealType.uint64),
             cnt_monkey := SScratchVar(TealType.uint64),
-            cnt_items := SScratchVar(TealType.uint64),
             mod := SScratchVar(TealType.uint64),
+            # Part two progress: the item being followed, and its cycle checkpoint
+            src := SScratchVar(TealType.uint64),
+            pos := SScratchVar(TealType.uint64),
+            m := SScratchVar(TealType.uint64),
+            v := SScratchVar(TealType.uint64),
+            chk_m := SScratchVar(TealType.uint64),
+            chk_v := SScratchVar(TealType.uint64),
+            chk_round := SScratchVar(TealType.uint64),
+            power := SScratchVar(TealType.uint64),
+            (counts := SScratchVar(TealType.bytes), MAX_MONKEYS * 8),
+            (snap := SScratchVar(TealType.bytes), MAX_MONKEYS * 8),
+            (base := SScratchVar(TealType.bytes), MAX_MONKEYS * 8),
         )
-        items = BoxArrayStruct(alloc, Item, MAX_ITEMS)
+        # The worry levels of the items each monkey holds, 8 bytes each
+        items = BoxArray(alloc, MAX_ITEMS * 8, MAX_MONKEYS)
         monkeys = BoxArrayStruct(alloc, Monkey, MAX_MONKEYS)
         items_bak = alloc.alloc(items.area.size)
         monkeys_bak = alloc.alloc(monkeys.area.size)
         cached = [scratch, items, monkeys]
 
         tmp = SScratchVar()
-        OLD = 2**64 - 1
+        OLD = 2**16 - 1
+
+        def Throw(to_: Expr, items_: ScratchVar):
+            return Seq(
+                (to := SScratchVar()).store(to_),
+                (size := SScratchVar()).store(monkeys[to].size.get()),
+                items.area.replace(
+                    to * items.element_size + size * Int(8), items_.load()
+                ),
+                monkeys[to].size.set(size + Len(items_.load()) / Int(8)),
+            )
+
+        top0 = SScratchVar()
+        top1 = SScratchVar()
+
+        def Top2(get):
+            return Seq(
+                top0.store(0),
+                top1.store(0),
+                For((i := SScratchVar()).store(0), i < cnt_monkey, i.inc()).Do(
+                    tmp.store(get(i)),
+                    If(tmp > top1).Then(
+                        top1.store(tmp), If(top1 > top0).Then(Swap(top0, top1))
+                    ),
+                ),
+            )
+
+        @Subroutine(TealType.none)
+        def Turn():
+            old = SScratchVar()
+
+            def Inspect(worry: Expr):
+                return For(
+                    (i := SScratchVar(TealType.uint64)).store(0),
+                    i < Len(held.load()),
+                    i.inc(8),
+                ).Do(
+                    old.store(ExtractUint64(held.load(), i.load())),
+                    worry,
+                    If(old % test)
+                    .Then(thrown_false.concat(Itob(old.load())))
+                    .Else(thrown_true.concat(Itob(old.load()))),
+                )
+
+            return Seq(
+                (monkey := monkeys[turn].record()).load(),
+                (arg := SScratchVar()).store(monkey.arg),
+                (op := SScratchVar()).store(monkey.op),
+                (test := SScratchVar()).store(monkey.test),
+                # Each turn throws all the items, to one of two monkeys: batch them
+                (held := SScratchVar()).store(
+                    items.area.extract(turn * items.element_size, monkey.size * Int(8))
+                ),
+                (thrown_true := SScratchVar()).store(""),
+                (thrown_false := SScratchVar()).store(""),
+                If(phase == 0).Then(
+                    Inspect(
+                        Seq(
+                            tmp.store(arg),
+                            If(tmp == OLD).Then(tmp.store(old)),
+                            If(op == "+")
+                            .Then(old.store(old + tmp))
+                            .Else(old.store(old * tmp)),
+                            old.store(old / 3),
+                        )
+                    )
+                )
+                # Part two runs most of the rounds: pick the operation once per turn
+                .ElseIf(arg == OLD)
+                .Then(Inspect(old.store(old * old % mod.load())))
+                .ElseIf(op == "+")
+                .Then(Inspect(old.store((old + arg) % mod.load())))
+                .Else(Inspect(old.store(old * arg % mod.load()))),
+                monkeys[turn].set_fields(cnt=monkey.cnt + monkey.size, size=0),
+                Throw(monkey.if_true, thrown_true),
+                Throw(monkey.if_false, thrown_false),
+                turn.inc(),
+                If(turn == cnt_monkey).Then(
+                    turn.store(0),
+                    round.inc(),
+                    If(And(phase == 0, round == 20))
+                    .Then(
+                        Top2(lambda i: monkeys[i].cnt.get()),
+                        self.set_solution(part_one=top0 * top1),
+                        monkeys.area.copy(monkeys_bak),
+                        items.area.copy(items_bak),
+                        counts.store(BytesZero(Int(MAX_MONKEYS * 8))),
+                        phase.inc(),
+                    )
+                    .ElseIf(round == 10000)
+                    .Then(
+                        # Done with the items left, back to totalling the counts
+                        For((i := SScratchVar()).store(0), i < cnt_monkey, i.inc()).Do(
+                            tmp.store(i * Int(8)),
+                            counts.store(
+                                Replace(
+                                    counts.load(),
+                                    tmp.load(),
+                                    Itob(
+                                        ExtractUint64(counts.load(), tmp.load())
+                                        + monkeys[i].cnt.get()
+                                    ),
+                                )
+                            ),
+                        ),
+                        src.store(cnt_monkey),
+                        phase.store(1),
+                    ),
+                ),
+            )
+
+        @Subroutine(TealType.none)
+        def NextItem():
+            return Seq(
+                m.store(src),
+                v.store(
+                    Btoi(
+                        items.area.extract(
+                            src * items.element_size + pos * Int(8), Int(8)
+                        )
+                    )
+                ),
+                pos.inc(),
+                round.store(0),
+                chk_m.store(m),
+                chk_v.store(v),
+                chk_round.store(0),
+                power.store(1),
+                snap.store(counts),
+                base.store(counts),
+                phase.inc(),
+            )
+
+        # Without a short cycle, rounds of all the items left at once are cheaper: keep
+        # only those in the lists, the current one included, and run them in lockstep
+        @Subroutine(TealType.none)
+        def Lockstep():
+            return Seq(
+                counts.store(base),
+                pos.dec(),
+                For((i := SScratchVar()).store(0), i < src, i.inc()).Do(
+                    monkeys[i].size.set(0)
+                ),
+                (size := SScratchVar()).store(monkeys[src].size.get() - pos.load()),
+                items.area.replace(
+                    src * items.element_size,
+                    items.area.extract(
+                        src * items.element_size + pos * Int(8), size * Int(8)
+                    ),
+                ),
+                monkeys[src].size.set(size),
+                round.store(0),
+                phase.store(3),
+            )
+
+        # One round of the current item: it stays in the round while it is thrown to
+        # monkeys that still have to take their turn
+        @Subroutine(TealType.none)
+        def ItemRound():
+            return Seq(
+                Forever().Do(
+                    (monkey := monkeys[m].record()).load(),
+                    tmp.store(monkey.arg),
+                    If(tmp == OLD).Then(tmp.store(v)),
+                    If(monkey.op == Bytes("+"))
+                    .Then(v.store((v + tmp) % mod.load()))
+                    .Else(v.store(v * tmp % mod.load())),
+                    tmp.store(m * Int(8)),
+                    counts.store(
+                        Replace(
+                            counts.load(),
+                            tmp.load(),
+                            Itob(ExtractUint64(counts.load(), tmp.load()) + Int(1)),
+                        )
+                    ),
+                    tmp.store(m),
+                    If(v % monkey.test)
+                    .Then(m.store(monkey.if_false))
+                    .Else(m.store(monkey.if_true)),
+                    If(m < tmp).Then(Break()),
+                ),
+                round.inc(),
+                # The (monkey, worry) state at round boundaries eventually cycles:
+                # Brent's detection against a checkpoint, whose window doubles
+                If(And(power.load(), m == chk_m, v == chk_v))
+                .Then(
+                    # Skip all the whole cycles left, repeating their inspections
+                    tmp.store(round - chk_round),
+                    (cycles := SScratchVar()).store(
+                        (Int(10000) - round.load()) / tmp.load()
+                    ),
+                    For((i := SScratchVar()).store(0), i < cnt_monkey, i.inc()).Do(
+                        (cnt := SScratchVar()).store(
+                            ExtractUint64(counts.load(), i * Int(8))
+                        ),
+                        counts.store(
+                            Replace(
+                                counts.load(),
+                                i * Int(8),
+                                Itob(
+                                    cnt
+                                    + cycles
+                                    * (cnt - ExtractUint64(snap.load(), i * Int(8)))
+                                ),
+                            )
+                        ),
+                    ),
+                    round.store(round + cycles * tmp),
+                    power.store(0),
+                )
+                .ElseIf(round - chk_round == power.load())
+                .Then(
+                    If(power == MAX_POWER)
+                    .Then(Lockstep())
+                    .Else(
+                        chk_m.store(m),
+                        chk_v.store(v),
+                        chk_round.store(round),
+                        snap.store(counts),
+                        power.store(power * Int(2)),
+                    ),
+                ),
+                If(And(phase == 2, round == 10000)).Then(phase.store(1)),
+            )
 
         return Seq(
             tmp.store(0),
@@ -81,19 +318,21 @@ class Solution(Base):
                     self.reader_index().inc(7),
                     Assert(self.reader_next_uint(tmp)),
                     Assert(tmp == cnt_monkey),
-                    monkeys[cnt_monkey].cnt.set(0),
                     self.reader_index().inc(19),
+                    (held := SScratchVar()).store(""),
                     Forever().Do(
                         Assert(self.reader_next_uint(tmp)),
-                        items[cnt_items].value.set(tmp),
-                        items[cnt_items].monkey.set(cnt_monkey),
-                        cnt_items.inc(),
+                        held.concat(Itob(tmp.load())),
                         If(
                             self.reader_get(self.reader_index() - 1, Int(1))
                             == Bytes("\n")
                         ).Then(Break()),
                         self.reader_index().inc(),
                     ),
+                    items.area.replace(cnt_monkey * items.element_size, held),
+                    monkeys[cnt_monkey].set_fields(
+                        cnt=0, size=Len(held.load()) / Int(8)
+                    ),
                     #
                     Assert(
                         self.reader_next(Int(23)) == Bytes("  Operation: new = old ")
@@ -144,61 +383,23 @@ class Solution(Base):
             #
             Forever().Do(
                 self.check_low_budget(self.flush(state, cached), 5),
-                (insp := SScratchVar(TealType.uint64)).store(monkeys[turn].cnt),
-                (arg := SScratchVar()).store(monkeys[turn].arg),
-                (op := SScratchVar()).store(monkeys[turn].op),
-                (test := SScratchVar()).store(monkeys[turn].test),
-                (if_false := SScratchVar()).store(monkeys[turn].if_false),
-                (if_true := SScratchVar()).store(monkeys[turn].if_true),
-                For(
-                    (i := SScratchVar(TealType.uint64)).store(0), i < cnt_items, i.inc()
-                ).Do(
-                    If(items[i].monkey.get() != turn.load()).Then(Continue()),
-                    insp.inc(),
-                    (old := SScratchVar()).store(items[i].value),
-                    tmp.store(arg),
-                    If(tmp == OLD).Then(tmp.store(old)),
-                    If(op == "+").Then(old.store(old + tmp)).Else(old.store(old * tmp)),
-                    If(phase == 0)
+                If(phase == 2)
+                .Then(ItemRound())
+                .ElseIf(phase == 1)
+                .Then(
+                    # Items never interact once the worry is not divided anymore:
+                    # follow each of them on its own for all the rounds
+                    If(src == cnt_monkey)
                     .Then(
-                        old.store(old / 3),
+                        Top2(lambda i: ExtractUint64(counts.load(), i * Int(8))),
+                        self.set_solution(part_two=top0 * top1),
+                        Break(),
                     )
-                    .Else(
-                        old.store(old % mod),
-                    ),
-                    items[i].value.set(old),
-                    If(old % test)
-                    .Then(items[i].monkey.set(if_false))
-                    .Else(items[i].monkey.set(if_true)),
-                ),
-                monkeys[turn].cnt.set(insp),
-                turn.inc(),
-                If(turn == cnt_monkey).Then(
-                    turn.store(0),
-                    round.inc(),
-                    If(Or(And(phase == 0, round == 20), round == 10000)).Then(
-                        (top0 := SScratchVar()).store(0),
-                        (top1 := SScratchVar()).store(0),
-                        For((i := SScratchVar()).store(0), i < cnt_monkey, i.inc()).Do(
-                            tmp.store(monkeys[i].cnt.get()),
-                            If(tmp > top1).Then(
-                                top1.store(tmp), If(top1 > top0).Then(Swap(top0, top1))
-                            ),
-                        ),
-                        If(phase == 0)
-                        .Then(
-                            self.set_solution(part_one=top0 * top1),
-                            phase.inc(),
-                            round.store(0),
-                            monkeys.area.copy(monkeys_bak),
-                            items.area.copy(items_bak),
-                        )
-                        .Else(
-                            self.set_solution(part_two=top0 * top1),
-                            Break(),
-                        ),
-                    ),
-                ),
+                    .ElseIf(pos == monkeys[src].size.get())
+                    .Then(src.inc(), pos.store(0))
+                    .Else(NextItem()),
+                )
+                .Else(Turn()),
             ),
             self.flush(state, cached),
             Return(TRUE),
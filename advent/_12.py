@@ -7,6 +7,7 @@ from beaker.consts import TRUE, FALSE
 from .base import Base
 from .utils import (
     BoxArrayCustom,
+    BoxDeque,
     BoxScratchStore,
     Forever,
     SScratchVar,
@@ -16,13 +17,15 @@ from .utils import (
 MAX_ROWS = 50
 MAX_COLS = 110
 MAX_MAP = MAX_ROWS * MAX_COLS
+# BFS frontier, a couple of distance layers: pushing past it fails
+MAX_QUEUE = 2 * (MAX_ROWS + MAX_COLS)
 
 
 class Solution(Base):
     work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=1)
 
     def work_box_size(self):
-        return 8 * 8 + 2 * MAX_MAP * 2
+        return 8 * 6 + 2 * MAX_MAP + 8 * 2 + 2 * MAX_QUEUE
 
     def flush(self, state: dict, cached):
         return Seq(self.save_work(state), Seq([x.flush() for x in cached]))
@@ -41,8 +44,6 @@ class Solution(Base):
             rows := SScratchVar(TealType.uint64),
             cols := SScratchVar(TealType.uint64),
             size := SScratchVar(TealType.uint64),
-            queue_start := SScratchVar(TealType.uint64),
-            queue_end := SScratchVar(TealType.uint64),
             best := SScratchVar(TealType.uint64),
         )
         dist = BoxArrayCustom(
@@ -52,21 +53,15 @@ class Solution(Base):
             lambda x: uint_encode(16, x),
             lambda x: ExtractUint16(x, Int(0)),
         )
-        queue = BoxArrayCustom(
-            alloc,
-            2,
-            MAX_MAP,
-            lambda x: uint_encode(16, x),
-            lambda x: ExtractUint16(x, Int(0)),
-        )
-        cached = [scratch]
+        queue = BoxDeque(alloc, 2, MAX_QUEUE, cache_area=True)
+        cached = [scratch, queue]
 
         map_index = lambda x: x + x / cols
         UNK = Int(2**16 - 1)
 
         qp = SScratchVar(TealType.uint64)
-        push = lambda x: Seq(queue[queue_end].set(x), queue_end.inc())
-        pop = lambda x=qp: Seq(x.store(queue[queue_start].get()), queue_start.inc())
+        push = lambda x: queue.push_back(x)
+        pop = lambda x=qp: queue.pop_front(x)
 
         c = SScratchVar()
         nd = SScratchVar(TealType.uint64)
@@ -114,16 +109,13 @@ class Solution(Base):
                 work_box.store(self.work_box()),
                 Seq([x.cache() for x in cached]),
                 scratch.init(),
+                queue.init(),
                 cols.store(Len(self.reader_next_line())),
                 rows.store(self.input_size.get() / (cols + 1)),
                 size.store(cols * rows),
                 #
                 (line := SScratchVar()).store(""),
-                For((i := SScratchVar()).store(0), i < MAX_ROWS, i.inc()).Do(
-                    dist.area.replace(
-                        i * (MAX_COLS * dist.element_size), b"\xff\xff" * MAX_COLS
-                    ),
-                ),
+                dist.area.fill(255),
                 For((i := SScratchVar()).store(0), i < size, i.inc()).Do(
                     (z := SScratchVar()).store(i % cols),
                     If(z.load())
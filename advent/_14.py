@@ -5,8 +5,10 @@ from beaker.consts import TRUE
 
 from .base import Base
 from .utils import (
-    BoxArray,
+    BitCount,
+    BoxGrid,
     BoxScratchStore,
+    BoxStack,
     Forever,
     Max,
     Min,
@@ -17,13 +19,18 @@ from .utils import (
 
 MAP_W = 150
 MAP_H = 200
+# A spare byte on each side of the map, so rows can be shifted by a bit
+GRID_W = (MAP_W // 8 + 3) * 8
+GRID_X = 8
+# The falling sand path goes from the source down to the floor, maxY + 1 < MAP_H + 1
+PATH_LEN = MAP_H + 2
 
 
 class Solution(Base):
     work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=1)
 
     def work_box_size(self):
-        return 8 * 13 + MAP_W * MAP_H
+        return 8 * 13 + GRID_W // 8 * MAP_H + 8 + 2 * PATH_LEN
 
     def flush(self, state: dict, cached):
         return Seq(self.save_work(state), Seq([x.flush() for x in cached]))
@@ -51,14 +58,15 @@ class Solution(Base):
             h_left := SScratchVar(TealType.uint64),
             h_right := SScratchVar(TealType.uint64),
         )
-        map = BoxArray(alloc, 1, MAP_H * MAP_W)
-        cached = [scratch]
+        # Cells blocked by rock or sand, then in the last phase the ones sand reaches
+        grid = BoxGrid(alloc, GRID_W, MAP_H, cell_bits=1)
+        # Path of the falling sand, the next unit starts where the last one came to rest
+        path = BoxStack(alloc, 2, PATH_LEN, cache_area=True)
+        cached = [scratch, path]
 
         INF = 2**64 - 1
 
-        map_coord = lambda x, y: x + y * Int(MAP_W)
-        map_get = lambda x, y: map[map_coord(x, y)].get()
-        map_set = lambda x, y, v: map[map_coord(x, y)].set(v)
+        map_coord = lambda x, y: x + Int(GRID_X) + y * Int(GRID_W)
 
         return Seq(
             self.init_state(state),
@@ -109,16 +117,18 @@ class Solution(Base):
                                 (i := SScratchVar()).store(Min(Y.load(), lastY.load())),
                                 i <= lim,
                                 i.inc(),
-                            ).Do(map_set(X, i, "#")),
+                            ).Do(grid.set(X + Int(GRID_X), i, 1)),
                         )
                         .ElseIf(Y == lastY)
                         .Then(
                             (lim := SScratchVar()).store(Max(X.load(), lastX.load())),
+                            grid.load(Y),
                             For(
                                 (i := SScratchVar()).store(Min(X.load(), lastX.load())),
                                 i <= lim,
                                 i.inc(),
-                            ).Do(map_set(i, Y, "#")),
+                            ).Do(grid.set_cell(i + Int(GRID_X), 1)),
+                            grid.store(Y),
                         )
                     ),
                     If(self.reader_done())
@@ -140,70 +150,75 @@ class Solution(Base):
                 )
                 .ElseIf(phase == 2)
                 .Then(
-                    X.store(500),
-                    X.dec(shift),
-                    Y.store(0),
+                    If(path.empty()).Then(
+                        path.push(map_coord(Int(500) - shift.load(), Int(0)))
+                    ),
+                    (pos := SScratchVar()).store(path.top()),
+                    (abyss := SScratchVar()).store((maxY + 1) * Int(GRID_W)),
                     Forever().Do(
-                        tmp.store(Y + 1),
-                        If(map_get(X, tmp) == Bytes("\0"))
-                        .Then(
-                            Y.inc(),
-                        )
-                        .ElseIf(map_get(X - 1, tmp) == Bytes("\0"))
-                        .Then(
-                            Y.inc(),
-                            X.dec(),
-                        )
-                        .ElseIf(map_get(X + 1, tmp) == Bytes("\0"))
-                        .Then(
-                            Y.inc(),
-                            X.inc(),
-                        )
-                        .Else(map_set(X, Y, "o"), cnt.inc(), Break()),
-                        If(Y > maxY).Then(
+                        (x := SScratchVar()).store(pos % GRID_W),
+                        (y := SScratchVar()).store(pos / GRID_W),
+                        (below := SScratchVar()).store(grid.line(y + 1).get()),
+                        If(Not(grid.cell(x, below.load())))
+                        .Then(pos.inc(GRID_W))
+                        .ElseIf(Not(grid.cell(x - 1, below.load())))
+                        .Then(pos.inc(GRID_W - 1))
+                        .ElseIf(Not(grid.cell(x + 1, below.load())))
+                        .Then(pos.inc(GRID_W + 1))
+                        .Else(grid.set(x, y, 1), cnt.inc(), path.size.dec(), Break()),
+                        path.push(pos),
+                        If(pos >= abyss).Then(
                             phase.inc(),
                             cnt2.inc(),
                             X.store(500),
                             X.dec(shift),
-                            Y.store(0),
-                            map_set(X, Y, "X"),
-                            Y.inc(),
+                            # Rows now hold the cells reached, starting from the source
+                            grid.line(0).set(
+                                SetBit(
+                                    BytesZero(Int(grid.line_size)),
+                                    X + Int(GRID_X),
+                                    Int(1),
+                                )
+                            ),
+                            Y.store(1),
                             Break(),
                         ),
                     ),
                 )
                 .ElseIf(phase == 3)
                 .Then(
-                    If(Int(500) - shift.load() >= Y.load())
-                    .Then(X.store(Int(500) - shift.load() - Y.load()))
-                    .Else(
-                        X.store(0),
-                    ),
-                    (ok := SScratchVar()).store(0),
-                    (y := SScratchVar()).store(Y - 1),
+                    # Reached from any of the 3 cells above, unless blocked
+                    (prev := SScratchVar()).store(grid.line(Y - 1).get()),
                     tmp.store(maxX + 1 - shift.load()),
-                    For(
-                        (lim := SScratchVar()).store(
-                            Min(tmp.load(), Int(500) - shift.load() + Y.load())
-                        ),
-                        X <= lim,
-                        X.inc(),
-                    ).Do(
-                        If(map_get(X, Y) == Bytes("#")).Then(Continue()),
-                        ok.store(0),
-                        If(X > 0).Then(
-                            If(map_get(X - 1, y) == Bytes("X")).Then(ok.store(1))
-                        ),
-                        If(map_get(X, y) == Bytes("X")).Then(ok.store(1)),
-                        If(map_get(X + 1, y) == Bytes("X")).Then(ok.store(1)),
-                        If(ok.load()).Then(
-                            map_set(X, Y, "X"),
-                            cnt2.inc(),
-                            If(And(X == 0, h_left == 0)).Then(h_left.store(Y)),
-                            If(And(X == tmp.load(), h_right == 0)).Then(
-                                h_right.store(Y)
+                    (edges := SScratchVar()).store(
+                        SetBit(
+                            SetBit(
+                                BytesZero(Int(grid.line_size)),
+                                Int(GRID_X - 1),
+                                Int(1),
                             ),
-                        ),
+                            tmp + Int(GRID_X + 1),
+                            Int(1),
+                        )
+                    ),
+                    (row := SScratchVar()).store(
+                        BytesAnd(
+                            BytesOr(
+                                BytesOr(
+                                    prev.load(), BytesMul(prev.load(), Bytes(b"\2"))
+                                ),
+                                BytesDiv(prev.load(), Bytes(b"\2")),
+                            ),
+                            BytesNot(BytesOr(grid.line(Y).get(), edges.load())),
+                        )
+                    ),
+                    grid.line(Y).set(row),
+                    cnt2.inc(BitCount(row.load(), grid.line_size)),
+                    If(And(h_left == 0, grid.cell(Int(GRID_X), row.load()))).Then(
+                        h_left.store(Y)
+                    ),
+                    If(And(h_right == 0, grid.cell(tmp + GRID_X, row.load()))).Then(
+                        h_right.store(Y)
                     ),
                     Y.inc(),
                     If(Y == maxY + 2).Then(
@@ -211,6 +226,9 @@ class Solution(Base):
                         cnt2.inc(tmp * (tmp - 1) / Int(2)),
                         tmp.store(maxY + 2 - h_right.load()),
                         cnt2.inc(tmp * (tmp - 1) / Int(2)),
+                        # Sand only rests where the cells below are blocked, so it
+                        # can stay in the grid and just be counted again
+                        cnt2.inc(cnt),
                         phase.inc(),
                     ),
                 )
@@ -1,25 +1,30 @@
+import re
+
 from pyteal import *
 from beaker import *
 from beaker.decorators import *
 from beaker.consts import TRUE, FALSE
 
 from .base import Base
+from .client_base import ClientBase
 from .utils import (
     AbsDiff,
     BoxArrayStruct,
     BoxScratchStore,
     Forever,
+    HeapSort,
+    Int32,
     Max,
     Min,
     Nop,
     SLog,
-    Sort,
     SScratchVar,
     BoxAllocator,
     itoa,
 )
 
 MAX_S = 30
+MID = 2**62  # Coordinates are offset by this, so they're never negative
 
 
 class Endpoint:
@@ -30,7 +35,17 @@ class Endpoint:
 class Rhombus:
     cx = Int
     cy = Int
-    r = Int
+    r = Int32
+
+
+class Client(ClientBase):
+    @staticmethod
+    def encode_input(input: str) -> bytes:
+        # Sensor at x=3658485, y=2855273: closest beacon is at x=4263070, y=2991690
+        # becomes the 4 offset coordinates, 8 bytes each
+        return b"".join(
+            (MID + int(x)).to_bytes(8, "big") for x in re.findall(r"-?\d+", input)
+        )
 
 
 class Solution(Base):
@@ -66,13 +81,9 @@ class Solution(Base):
         rhs = BoxArrayStruct(alloc, Rhombus, MAX_S)
         cached = [scratch, endpoints]
 
-        MID = Int(2**62)
-        LINE = Int(2**62 + (10 if self.is_test else 2000000))
-        COORD_MIN = MID
-        COORD_MAX = Int(2**62 + (20 if self.is_test else 4000000))
-
-        def offset(x, sign):
-            return If(sign.load()).Then(MID - x.load()).Else(MID + x.load())
+        LINE = Int(MID + (10 if self.is_test else 2000000))
+        COORD_MIN = Int(MID)
+        COORD_MAX = Int(MID + (20 if self.is_test else 4000000))
 
         def endpoints_cmp(a, b):
             return (
@@ -83,19 +94,22 @@ class Solution(Base):
                 .Else(FALSE)
             )
 
+        # Resumable, one sift down per loop iteration
+        sorter = HeapSort(endpoints, endpoints_size, endpoints_cmp, index)
+
         @Subroutine(TealType.uint64)
         def check_point(x: Expr, y: Expr):
             return Seq(
                 If(And(Min(x, y) >= COORD_MIN, Max(x, y) <= COORD_MAX)).Then(
                     For((i := SScratchVar()).store(0), i < rhs_size, i.inc()).Do(
-                        If(
-                            AbsDiff(rhs[i].cx, x) + AbsDiff(rhs[i].cy, y)
-                            <= rhs[i].r.get()
-                        ).Then(
+                        (rh := rhs[i].record()).load(),
+                        If(AbsDiff(rh.cx, x) + AbsDiff(rh.cy, y) <= rh.r).Then(
                             Return(Int(0)),
-                        )
+                        ),
+                    ),
+                    self.set_solution(
+                        part_two=((x - Int(MID)) * Int(4000000) + (y - Int(MID)))
                     ),
-                    self.set_solution(part_two=((x - MID) * Int(4000000) + (y - MID))),
                     Return(Int(1)),
                 ),
                 Return(Int(0)),
@@ -155,7 +169,6 @@ class Solution(Base):
             (sy := SScratchVar()).store(0),
             (bx := SScratchVar()).store(0),
             (by := SScratchVar()).store(0),
-            (sign := SScratchVar()).store(0),
             If(work_box == "")
             .Then(
                 work_box.store(self.work_box()),
@@ -169,22 +182,14 @@ class Solution(Base):
                 #
                 If(phase == 0)
                 .Then(
-                    # Sensor at x=3658485, y=2855273: closest beacon is at x=4263070, y=2991690
-                    self.reader_skip(12),
-                    Assert(self.reader_next_int(sx, sign)),
-                    sx.store(offset(sx, sign)),
-                    #
-                    self.reader_skip(3),
-                    Assert(self.reader_next_int(sy, sign)),
-                    sy.store(offset(sy, sign)),
-                    #
-                    self.reader_skip(24),
-                    Assert(self.reader_next_int(bx, sign)),
-                    bx.store(offset(bx, sign)),
-                    #
-                    self.reader_skip(3),
-                    Assert(self.reader_next_int(by, sign)),
-                    by.store(offset(by, sign)),
+                    # Sensor and beacon coordinates, see `Client.encode_input`
+                    (record := SScratchVar(TealType.bytes)).store(
+                        self.reader_next(Int(32))
+                    ),
+                    sx.store(ExtractUint64(record.load(), Int(0))),
+                    sy.store(ExtractUint64(record.load(), Int(8))),
+                    bx.store(ExtractUint64(record.load(), Int(16))),
+                    by.store(ExtractUint64(record.load(), Int(24))),
                     #
                     (dist := SScratchVar()).store(
                         AbsDiff(sx.load(), bx.load()) + AbsDiff(sy.load(), by.load())
@@ -192,102 +197,97 @@ class Solution(Base):
                     (dist_line := SScratchVar()).store(AbsDiff(sy.load(), LINE)),
                     If(dist_line <= dist).Then(
                         (r := SScratchVar()).store(dist - dist_line),
-                        endpoints[endpoints_size].pos.set(sx - r),
-                        endpoints[endpoints_size].close.set(b"\0"),
+                        endpoints[endpoints_size].set_fields(pos=sx - r, close=b"\0"),
                         endpoints_size.inc(),
-                        endpoints[endpoints_size].pos.set(sx + r),
-                        endpoints[endpoints_size].close.set(b"\1"),
+                        endpoints[endpoints_size].set_fields(pos=sx + r, close=b"\1"),
                         endpoints_size.inc(),
                     ),
-                    rhs[rhs_size].cx.set(sx),
-                    rhs[rhs_size].cy.set(sy),
-                    rhs[rhs_size].r.set(dist),
+                    rhs[rhs_size].set_fields(cx=sx, cy=sy, r=dist),
                     rhs_size.inc(),
                     If(self.reader_done()).Then(index.store(0), phase.inc()),
                 )
                 .ElseIf(phase == 1)
                 .Then(
-                    self.check_low_budget(self.flush(state, cached), budget=50000),
-                    Sort(endpoints, endpoints_size, endpoints_cmp),
+                    If(Not(sorter.done())).Then(sorter.step(), Continue()),
                     (open := SScratchVar()).store(0),
                     (last := SScratchVar()).store(0),
                     For((i := SScratchVar()).store(0), i < endpoints_size, i.inc()).Do(
-                        If(endpoints[i].close.get() == Bytes("\0"))
+                        (endpoint := endpoints[i].record()).load(),
+                        If(endpoint.close == Bytes("\0"))
                         .Then(
-                            If(open == 0).Then(last.store(endpoints[i].pos.get())),
+                            If(open == 0).Then(last.store(endpoint.pos)),
                             open.inc(),
                         )
                         .Else(
                             open.dec(),
-                            If(open == 0).Then(
-                                ans.inc(endpoints[i].pos.get() - last.load())
-                            ),
-                        )
+                            If(open == 0).Then(ans.inc(endpoint.pos - last.load())),
+                        ),
                     ),
                     phase.inc(),
                     index.store(0),
                     index2.store(0),
-                    sign.store(0),
                 )
                 .ElseIf(phase == 2)
                 .Then(
+                    (a := rhs[index].record()).load(),
                     If(index == index2)
                     .Then(
-                        (tmp := SScratchVar()).store(rhs[index].r.get() + Int(1)),
+                        (tmp := SScratchVar()).store(a.r + Int(1)),
                         If(
                             check_point(
-                                rhs[index].cx.get() + tmp.load(),
-                                rhs[index].cy.get(),
+                                a.cx + tmp.load(),
+                                a.cy,
                             )
                             + check_point(
-                                rhs[index].cx.get() - tmp.load(),
-                                rhs[index].cy.get(),
+                                a.cx - tmp.load(),
+                                a.cy,
                             )
                             + check_point(
-                                rhs[index].cx.get(),
-                                rhs[index].cy.get() + tmp.load(),
+                                a.cx,
+                                a.cy + tmp.load(),
                             )
                             + check_point(
-                                rhs[index].cx.get(),
-                                rhs[index].cy.get() - tmp.load(),
+                                a.cx,
+                                a.cy - tmp.load(),
                             )
                         ).Then(phase.inc(), Continue()),
                     )
                     .Else(
+                        (b := rhs[index2].record()).load(),
                         If(
                             intersect_and_check(
-                                rhs[index].cx.get(),
-                                rhs[index].cy.get() - rhs[index].r.get(),
-                                rhs[index].r.get(),
-                                rhs[index2].cx.get(),
-                                rhs[index2].cy.get() - rhs[index2].r.get(),
-                                rhs[index2].r.get(),
+                                a.cx,
+                                a.cy - a.r,
+                                a.r,
+                                b.cx,
+                                b.cy - b.r,
+                                b.r,
                             )
                             + intersect_and_check(
-                                rhs[index].cx.get(),
-                                rhs[index].cy.get() - rhs[index].r.get(),
-                                rhs[index].r.get(),
-                                rhs[index2].cx.get() + rhs[index2].r.get(),
-                                rhs[index2].cy.get(),
-                                rhs[index2].r.get(),
+                                a.cx,
+                                a.cy - a.r,
+                                a.r,
+                                b.cx + b.r,
+                                b.cy,
+                                b.r,
                             )
                             + intersect_and_check(
-                                rhs[index].cx.get() - rhs[index].r.get(),
-                                rhs[index].cy.get(),
-                                rhs[index].r.get(),
-                                rhs[index2].cx.get(),
-                                rhs[index2].cy.get() - rhs[index2].r.get(),
-                                rhs[index2].r.get(),
+                                a.cx - a.r,
+                                a.cy,
+                                a.r,
+                                b.cx,
+                                b.cy - b.r,
+                                b.r,
                             )
                             + intersect_and_check(
-                                rhs[index].cx.get() - rhs[index].r.get(),
-                                rhs[index].cy.get(),
-                                rhs[index].r.get(),
-                                rhs[index2].cx.get() + rhs[index2].r.get(),
-                                rhs[index2].cy.get(),
-                                rhs[index2].r.get(),
+                                a.cx - a.r,
+                                a.cy,
+                                a.r,
+                                b.cx + b.r,
+                                b.cy,
+                                b.r,
                             )
-                        ).Then(phase.inc(), Continue())
+                        ).Then(phase.inc(), Continue()),
                     ),
                     index2.inc(),
                     If(index2 == rhs_size).Then(
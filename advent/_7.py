@@ -4,7 +4,7 @@ from beaker.decorators import *
 from beaker.consts import TRUE
 
 from .base import Base
-from .utils import Nop, SScratchVar, BoxAllocator, BoxArrayUint, Forever, Findi, atoi
+from .utils import Nop, SScratchVar, BoxAllocator, BoxStack, Forever, Findi, atoi
 
 MAX_DEPTH = 200  # >count(cd ..)
 DISK_SIZE = 70000000
@@ -12,11 +12,11 @@ DISK_REQUIRED = 30000000
 
 
 class Solution(Base):
-    work_ints = ReservedAccountStateValue(TealType.uint64, max_keys=5)
+    work_ints = ReservedAccountStateValue(TealType.uint64, max_keys=4)
     work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=1)
 
     def work_box_size(self):
-        return MAX_DEPTH * 8
+        return 8 + MAX_DEPTH * 8
 
     def flush(self, state: dict, cached):
         return Seq(self.save_work(state), Seq([x.flush() for x in cached]))
@@ -28,11 +28,10 @@ class Solution(Base):
             phase=(phase := SScratchVar(TealType.uint64)),
             current=(current := SScratchVar(TealType.uint64)),
             total=(total := SScratchVar(TealType.uint64)),
-            index=(index := SScratchVar(TealType.uint64)),
             target=(target := SScratchVar(TealType.uint64)),
         )
         alloc = BoxAllocator(work_box.load())
-        path = BoxArrayUint(alloc, MAX_DEPTH)
+        path = BoxStack(alloc, 8, MAX_DEPTH, cache_area=True)
         cached = [path]
 
         line = SScratchVar()
@@ -44,7 +43,7 @@ class Solution(Base):
             .Then(
                 work_box.store(self.work_box()),
                 Seq([x.cache() for x in cached]),
-                path[0].set(0),
+                path.init(),
             )
             .Else(Seq([x.cache() for x in cached])),
             Forever().Do(
@@ -54,7 +53,7 @@ class Solution(Base):
                     line.store(self.reader_next_line()),
                 )
                 .Else(
-                    If(index == 0).Then(
+                    If(path.empty()).Then(
                         If(phase.load())
                         .Then(Break())
                         .Else(
@@ -84,15 +83,14 @@ class Solution(Base):
                     .Else(
                         If(current < 100000).Then(total.inc(current)),
                     ),
-                    index.dec(),
-                    current.inc(path[index]),
+                    path.pop(parent := SScratchVar(TealType.uint64)),
+                    current.inc(parent),
                     Continue(),
                 ),
                 (line_pre := SScratchVar()).store(Extract(line.load(), Int(0), Int(4))),
                 If(line_pre == Bytes("$ cd"))
                 .Then(
-                    path[index].set(current),
-                    index.inc(),
+                    path.push(current),
                     current.store(0),
                 )
                 .ElseIf(line_pre == Bytes("dir "))
@@ -9,7 +9,7 @@ from .utils import (
     Nop,
     SScratchVar,
     BoxAllocator,
-    BoxArray,
+    BoxGrid,
     Forever,
 )
 
@@ -22,7 +22,7 @@ class Solution(Base):
     work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=1)
 
     def work_box_size(self):
-        return MAX_SIDE * (MAX_SIDE // 8 + 1)
+        return MAX_SIDE * ((MAX_SIDE + 7) // 8) + MAX_SIDE
 
     def flush(self, state: dict, cached):
         return Seq(self.save_work(state), Seq([x.flush() for x in cached]))
@@ -39,10 +39,13 @@ class Solution(Base):
             best=(best := SScratchVar(TealType.uint64)),
         )
         alloc = BoxAllocator(work_box.load())
-        mask = BoxArray(alloc, MAX_SIDE // 8 + 1, MAX_SIDE)
-        cached = [mask]
+        mask = BoxGrid(alloc, MAX_SIDE, MAX_SIDE, cell_bits=1)
+        # The tallest tree met so far in each column by the current sweep
+        heights = alloc.alloc(MAX_SIDE)
+        cached = [mask, heights]
 
-        mask.cache()  # mark to be cached
+        for x in cached:
+            x.cache()  # mark to be cached
 
         i = SScratchVar(TealType.uint64)
         w = SScratchVar(TealType.uint64)
@@ -51,20 +54,22 @@ class Solution(Base):
         c = SScratchVar(TealType.uint64)
 
         line_buffer = SScratchVar()
+        tallest = SScratchVar(TealType.bytes)
 
         Fetch = lambda x: c.store(
             GetByte(line_buffer.load(), x)
             if x
             else GetByte(self.reader_get(h * (width + 1) + w.load(), Int(1)), Int(0))
         )
-        Check = lambda x, y=Seq(): Seq(
-            Fetch(x),
-            If(c <= cut).Then(y, Continue()),
-            cut.store(c),
-            If(GetBit(mask[h].get(), w.load())).Then(y, Continue()),
-            mask[h].set(SetBit(mask[h].get(), w.load(), Int(1))),
-            total.inc(),
-            If(cut == ord("9")).Then(Break()),
+        # Visible from the side the sweep comes from, or from the edge behind it
+        Mark = If(Not(mask.cell(w))).Then(mask.set_cell(w, 1), total.inc())
+        Sight = Seq(
+            c.store(GetByte(line_buffer.load(), w.load())),
+            If(c > cut).Then(cut.store(c), Mark),
+            If(c.load() > GetByte(tallest.load(), w.load())).Then(
+                tallest.store(SetByte(tallest.load(), w.load(), c.load())),
+                Mark,
+            ),
         )
         Reset = lambda x: Seq(
             index.inc(),
@@ -74,99 +79,42 @@ class Solution(Base):
             ),
         )
 
+        # Row by row from the top left corner, keeping the tallest tree met so far
+        # in each column
         @Subroutine(TealType.none)
-        def LoopLeft():
+        def SweepForward():
             return Seq(
                 h.store(index),
                 line_buffer.store(self.reader_get(h * (width + 1), width.load())),
-                For(w.store(0), w < width, w.inc()).Do(
-                    Check(w.load()),
-                ),
+                tallest.store(heights.extract(0, width.load())),
+                mask.load(h),
+                For(w.store(0), w < width, w.inc()).Do(Sight),
+                mask.store(h),
+                heights.replace(0, tallest.load()),
                 Reset(height),
             )
 
+        # Then back from the bottom right corner
         @Subroutine(TealType.none)
-        def LoopRight():
+        def SweepBackward():
             return Seq(
-                h.store(index),
+                h.store(height - index - Int(1)),
                 line_buffer.store(self.reader_get(h * (width + 1), width.load())),
+                If(index == 0)
+                .Then(tallest.store(BytesZero(width.load())))
+                .Else(tallest.store(heights.extract(0, width.load()))),
+                mask.load(h),
                 w.store(width - 1),
                 Forever().Do(
-                    Check(
-                        w.load(), (loop_step := Seq(If(w == 0).Then(Break()), w.dec()))
-                    ),
-                    loop_step,
+                    Sight,
+                    If(w == 0).Then(Break()),
+                    w.dec(),
                 ),
+                mask.store(h),
+                heights.replace(0, tallest.load()),
                 Reset(height),
             )
 
-        @Subroutine(TealType.none)
-        def LoopTop():
-            return Seq(
-                w.store(index),
-                line_buffer.store(""),
-                For(h.store(0), h < height, h.inc()).Do(
-                    If(h % MAX_LINES_BUFFERED == Int(0)).Then(
-                        i.store(h * (width + 1)),
-                        line_buffer.store(
-                            self.reader_get(
-                                i.load(),
-                                Min(
-                                    (width + 1) * Int(MAX_LINES_BUFFERED),
-                                    self.input_size.get() - i.load(),
-                                ),
-                            )
-                        ),
-                    ),
-                    Check((h % MAX_LINES_BUFFERED) * (width + 1) + w.load()),
-                ),
-                Reset(width),
-            )
-
-        @Subroutine(TealType.none)
-        def LoopBottom():
-            return Seq(
-                w.store(index),
-                h.store(height - 1),
-                (block_index_last := SScratchVar()).store(
-                    h / MAX_LINES_BUFFERED * Int(MAX_LINES_BUFFERED)
-                ),
-                i.store(block_index_last * (width + 1)),
-                line_buffer.store(
-                    self.reader_get(
-                        i.load(),
-                        Min(
-                            (width + 1) * Int(MAX_LINES_BUFFERED),
-                            self.input_size.get() - i.load(),
-                        ),
-                    )
-                ),
-                Forever().Do(
-                    (block_index := SScratchVar()).store(
-                        h / MAX_LINES_BUFFERED * Int(MAX_LINES_BUFFERED)
-                    ),
-                    If(block_index != block_index_last).Then(
-                        block_index_last.store(block_index),
-                        i.store(block_index_last * (width + 1)),
-                        line_buffer.store(
-                            self.reader_get(
-                                i.load(),
-                                Min(
-                                    (width + 1) * Int(MAX_LINES_BUFFERED),
-                                    self.input_size.get() - i.load(),
-                                ),
-                            )
-                        ),
-                    ),
-                    Check(
-                        (h % MAX_LINES_BUFFERED) * (width + 1) + w.load(),
-                        (loop_step := Seq(If(h == 0).Then(Break()), h.dec())),
-                    ),
-                    loop_step,
-                ),
-                Reset(width),
-            )
-
         @Subroutine(TealType.none)
         def LookAround():
             return Seq(
@@ -280,23 +228,17 @@ class Solution(Base):
                 (tmp := SScratchVar(TealType.bytes)).store(self.reader_next_line()),
                 width.store(Len(tmp.load())),
                 height.store(self.input_size.get() / (width + 1)),
-                For(i.store(0), i < height, i.inc()).Do(
-                    mask[i].set(b"\0" * mask.element_size)
-                ),
+                # The mask starts zeroed, the box was just created
             )
             .Else(Seq([x.cache() for x in cached])),
             Forever().Do(
                 self.check_low_budget(self.flush(state, cached), 10),
                 cut.store(ord("0") - 1),
                 If(phase == 0)
-                .Then(LoopLeft())
+                .Then(SweepForward())
                 .ElseIf(phase == 1)
-                .Then(LoopTop())
+                .Then(SweepBackward())
                 .ElseIf(phase == 2)
-                .Then(LoopRight())
-                .ElseIf(phase == 3)
-                .Then(LoopBottom())
-                .ElseIf(phase == 4)
                 .Then(LookAround())
                 .Else(Break()),
                 Nop(),
@@ -6,13 +6,14 @@ from beaker.consts import TRUE
 from .base import Base
 from .utils import (
     AbsDiff,
+    BitCount,
     BoxScratchStore,
     Max,
     Min,
     Nop,
     SScratchVar,
     BoxAllocator,
-    BoxArray,
+    BoxGrid,
     Forever,
 )
 
@@ -20,10 +21,13 @@ MAX_SPAN = 400
 
 
 class Solution(Base):
-    work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=1)
+    work_bytes = ReservedAccountStateValue(TealType.bytes, max_keys=2)
 
     def work_box_size(self):
-        return MAX_SPAN * (MAX_SPAN // 8 + 1) + 8 * (8 + 9 + 9)
+        return MAX_SPAN * MAX_SPAN // 8 + 8 * (9 + 9 + 9)
+
+    def extra_box_size(self):
+        return MAX_SPAN * MAX_SPAN // 8
 
     def flush(self, state: dict, cached):
         return Seq(self.save_work(state), Seq([x.flush() for x in cached]))
@@ -32,6 +36,7 @@ class Solution(Base):
     def solve_impl(self):
         state = dict(
             work_box=(work_box := SScratchVar(TealType.bytes)),
+            extra_box=(extra_box := SScratchVar(TealType.bytes)),
         )
         alloc = BoxAllocator(work_box.load())
         scratch = BoxScratchStore(
@@ -43,37 +48,46 @@ class Solution(Base):
             maxX := SScratchVar(TealType.uint64),
             minY := SScratchVar(TealType.uint64),
             maxY := SScratchVar(TealType.uint64),
-            unique := SScratchVar(TealType.uint64),
+            unique1 := SScratchVar(TealType.uint64),
+            unique9 := SScratchVar(TealType.uint64),
             *(tX := [SScratchVar(TealType.uint64) for _ in range(9)]),
             *(tY := [SScratchVar(TealType.uint64) for _ in range(9)]),
         )
-        mask = BoxArray(alloc, MAX_SPAN // 8 + 1, MAX_SPAN)
+        # The cells visited by knot 1, the tail of the short rope, and by knot 9: both
+        # don't fit in a single box
+        mask1 = BoxGrid(BoxAllocator(extra_box.load()), MAX_SPAN, MAX_SPAN, cell_bits=1)
+        mask9 = BoxGrid(alloc, MAX_SPAN, MAX_SPAN, cell_bits=1)
         cached = [scratch]
 
         midpoint = 2**32
 
         op = SScratchVar(TealType.bytes)
         amt = SScratchVar(TealType.uint64)
+        straight = SScratchVar(TealType.uint64)
 
-        MaskReset = For((i := SScratchVar()).store(0), i < MAX_SPAN, i.inc()).Do(
-            mask[i].set(b"\0" * mask.element_size)
-        )
-        MaskSet = lambda x, y: Seq(
+        MaskSet = lambda mask, x, y: mask.set(x - minX, y - minY, 1)
+        # Insert if absent, reading the row once
+        Visit = lambda mask, unique, x, y: Seq(
             (tmpY := SScratchVar()).store(y - minY),
-            mask[tmpY].set(SetBit(mask[tmpY].get(), x - minX, Int(1))),
+            mask.load(tmpY),
+            (tmpX := SScratchVar()).store(x - minX),
+            If(Not(mask.cell(tmpX))).Then(
+                mask.line(tmpY).set(mask.with_cell(tmpX, 1)),
+                unique.inc(),
+            ),
         )
-        MaskGet = lambda x, y: Seq(GetBit(mask[y - minY].get(), x - minX))
 
-        Move = lambda x: Seq(
+        Shift = lambda sX, sY, x: Seq(
             If(op == "L")
-            .Then(cX.dec(x))
+            .Then(sX.dec(x))
             .ElseIf(op == "R")
-            .Then(cX.inc(x))
+            .Then(sX.inc(x))
             .ElseIf(op == "U")
-            .Then(cY.dec(x))
+            .Then(sY.dec(x))
             .ElseIf(op == "D")
-            .Then(cY.inc(x)),
+            .Then(sY.inc(x)),
         )
+        Move = lambda x: Shift(cX, cY, x)
         Follow = lambda sX, sY, dX, dY: Seq(
             (deltaX := SScratchVar()).store(AbsDiff(sX.load(), dX.load())),
             (deltaY := SScratchVar()).store(AbsDiff(sY.load(), dY.load())),
@@ -92,6 +106,59 @@ class Solution(Base):
             .Then(dX.dec(), dY.dec()),
         )
 
+        def MakeVisitRun(mask: BoxGrid, unique: SScratchVar):
+            """Visit the `n` cells following (`x`, `y`) in the move direction."""
+            zero = BytesZero(Int(mask.line_size + 1))
+
+            @Subroutine(TealType.none)
+            def VisitRun(x: Expr, y: Expr, n: Expr):
+                return Seq(
+                    (tmpX := SScratchVar()).store(x - minX.load()),
+                    (tmpY := SScratchVar()).store(y - minY.load()),
+                    If(Or(op == "L", op == "R"))
+                    .Then(
+                        # Set the cells from `first` to `last` of the row at once, as the
+                        # difference of the powers of two bounding the run
+                        If(op == "R")
+                        .Then((first := SScratchVar()).store(tmpX + 1))
+                        .Else(first.store(tmpX - n)),
+                        (last := SScratchVar()).store(first + n - Int(1)),
+                        (run := SScratchVar()).store(
+                            BytesOr(
+                                BytesMinus(
+                                    SetBit(zero, first + Int(7), Int(1)),
+                                    SetBit(zero, last + Int(8), Int(1)),
+                                ),
+                                BytesZero(Int(mask.line_size)),
+                            )
+                        ),
+                        mask.load(tmpY),
+                        unique.inc(
+                            n
+                            - BitCount(
+                                BytesAnd(mask.buffer.load(), run.load()), mask.line_size
+                            )
+                        ),
+                        mask.buffer.store(BytesOr(mask.buffer.load(), run.load())),
+                        mask.store(tmpY),
+                    )
+                    .Else(
+                        For((k := SScratchVar()).store(1), k <= n, k.inc()).Do(
+                            If(op == "D").Then(tmpY.inc()).Else(tmpY.dec()),
+                            mask.load(tmpY),
+                            If(Not(mask.cell(tmpX))).Then(
+                                mask.line(tmpY).set(mask.with_cell(tmpX, 1)),
+                                unique.inc(),
+                            ),
+                        ),
+                    ),
+                )
+
+            return VisitRun
+
+        VisitRun1 = MakeVisitRun(mask1, unique1)
+        VisitRun9 = MakeVisitRun(mask9, unique9)
+
         @Subroutine(TealType.none)
         def FindBounds():
             return Seq(
@@ -100,10 +167,12 @@ class Solution(Base):
                     Assert(maxY - minY < Int(MAX_SPAN), comment="Y span is too large"),
                     cX.store(midpoint),
                     cY.store(midpoint),
-                    tX[0].store(cX),
-                    tY[0].store(cY),
-                    MaskSet(tX[0], tY[0]),
-                    unique.store(1),
+                    Seq([x.store(cX) for x in tX]),
+                    Seq([x.store(cY) for x in tY]),
+                    MaskSet(mask1, cX, cY),
+                    MaskSet(mask9, cX, cY),
+                    unique1.store(1),
+                    unique9.store(1),
                     phase.inc(),
                     self.reader_seek(0),
                     Return(),
@@ -118,40 +187,12 @@ class Solution(Base):
                 maxY.store(Max(maxY.load(), cY.load())),
             )
 
-        @Subroutine(TealType.none)
-        def Simulate():
-            return Seq(
-                If(self.reader_done()).Then(
-                    self.set_solution(part_one=unique),
-                    cX.store(midpoint),
-                    cY.store(midpoint),
-                    Seq([x.store(cX) for x in tX]),
-                    Seq([x.store(cY) for x in tY]),
-                    MaskReset,
-                    MaskSet(tX[-1], tY[-1]),
-                    unique.store(1),
-                    phase.inc(),
-                    self.reader_seek(0),
-                    Return(),
-                ),
-                op.store(self.reader_next(Int(1))),
-                self.reader_index().inc(),
-                Assert(self.reader_next_uint(amt)),
-                For((i := SScratchVar()).store(0), i < amt, i.inc()).Do(
-                    Move(1),
-                    Follow(cX, cY, tX[0], tY[0]),
-                    If(Not(MaskGet(tX[0], tY[0]))).Then(
-                        MaskSet(tX[0], tY[0]), unique.inc()
-                    ),
-                ),
-            )
-
         @Subroutine(TealType.none)
         def Simulate10():
             return Seq(
                 If(self.reader_done()).Then(
                     phase.inc(),
-                    self.set_solution(part_two=unique),
+                    self.set_solution(part_one=unique1, part_two=unique9),
                     Return(),
                 ),
                 op.store(self.reader_next(Int(1))),
@@ -159,10 +200,23 @@ class Solution(Base):
                 Assert(self.reader_next_uint(amt)),
                 For((i := SScratchVar()).store(0), i < amt, i.inc()).Do(
                     Move(1),
+                    # A knot that stays put holds all the following ones
                     Follow(cX, cY, tX[0], tY[0]),
+                    Visit(mask1, unique1, tX[0], tY[0]),
                     Seq([Follow(tX[i], tY[i], tX[i + 1], tY[i + 1]) for i in range(8)]),
-                    If(Not(MaskGet(tX[-1], tY[-1]))).Then(
-                        MaskSet(tX[-1], tY[-1]), unique.inc()
+                    Visit(mask9, unique9, tX[-1], tY[-1]),
+                    # Once all the knots line up behind the head, the whole rope just
+                    # slides along: the rest of the move is done in one go
+                    If(Or(op == "L", op == "R"))
+                    .Then(straight.store(And(*[y == cY for y in tY])))
+                    .Else(straight.store(And(*[x == cX for x in tX]))),
+                    If(straight.load()).Then(
+                        (rest := SScratchVar()).store(amt - i - Int(1)),
+                        VisitRun1(tX[0].load(), tY[0].load(), rest.load()),
+                        VisitRun9(tX[-1].load(), tY[-1].load(), rest.load()),
+                        Move(rest),
+                        Seq([Shift(tX[k], tY[k], rest) for k in range(9)]),
+                        i.store(amt),
                     ),
                 ),
             )
@@ -174,6 +228,7 @@ class Solution(Base):
             If(work_box == "")
             .Then(
                 work_box.store(self.work_box()),
+                extra_box.store(self.extra_box()),
                 Seq([x.cache() for x in cached]),
                 cX.store(midpoint),
                 cY.store(midpoint),
@@ -181,7 +236,6 @@ class Solution(Base):
                 maxX.store(cX),
                 minY.store(cY),
                 maxY.store(cY),
-                MaskReset,
             )
             .Else(Seq([x.cache() for x in cached])),
             #
@@ -190,8 +244,6 @@ class Solution(Base):
                 If(phase == 0)
                 .Then(FindBounds())
                 .ElseIf(phase == 1)
-                .Then(Simulate())
-                .ElseIf(phase == 2)
                 .Then(Simulate10())
                 .Else(Break()),
                 Nop(),
@@ -1,5 +1,7 @@
 import argparse
 import importlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 from tabulate import tabulate
 from beaker.sandbox import get_algod_client, get_accounts
@@ -10,7 +12,7 @@ from algosdk.constants import MICROALGOS_TO_ALGOS_RATIO
 from .third_party.account import Account, AppAccount
 from .base import Base
 from .client_base import ClientBase
-from .utils import fmt_algo, solver_user
+from .utils import fmt_algo, solver_user, user_pk
 
 parser = argparse.ArgumentParser()
 parser.add_argument("day", type=int)
@@ -21,21 +23,29 @@ parser.add_argument("--debug", action="store_true", default=False)
 parser.add_argument("--log", action="store_true", default=False)
 parser.add_argument("--example", action="store_true", default=False)
 parser.add_argument("--app", type=int, default=None)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=1,
+    help="Days to run in parallel, each in its own process",
+)
+parser.add_argument(
+    "--no-teal-cache", action="store_true", help="Always compile the programs"
+)
+parser.add_argument(
+    "--pipeline", type=int, default=1, help="Input/solve groups to keep in flight"
+)
+
+
+def run_day(day, args):
+    if args.no_teal_cache:
+        Base.TEAL_CACHE = None
+
+    if args.commit:
+        algod_client = algod.AlgodClient("", "https://testnet-api.algonode.cloud")
+    else:
+        algod_client = get_algod_client()
 
-args = parser.parse_args()
-
-if args.commit:
-    alogd_client = algod.AlgodClient("", "https://testnet-api.algonode.cloud")
-else:
-    alogd_client = get_algod_client()
-
-if args.day > 0:
-    args.day = [args.day]
-else:
-    args.day = list(range(1, -args.day + 1))
-
-day_stats = []
-for day in args.day:
     input_file = (
         Path(__file__).parent
         / ".."
@@ -46,19 +56,24 @@ for day in args.day:
     Solution = sol_module.Solution  # type: Base
     Client = getattr(sol_module, "Client", ClientBase)  # type: ClientBase
 
-    user = solver_user(alogd_client)
+    user = solver_user(algod_client)
 
     if not args.commit:
         faucet = get_accounts().pop()
-        Account(faucet.address, faucet.private_key, algod_client=alogd_client).pay(
+        Account(faucet.address, faucet.private_key, algod_client=algod_client).pay(
             user, 1000 * MICROALGOS_TO_ALGOS_RATIO
         )
 
+    # Read the balance once per stage, the lowest one is the funds needed
+    balances = [user.asa_balance(0)]
+
+    def spent():
+        balances.append(user.asa_balance(0))
+        return balances[-2] - balances[-1]
+
     if not args.quiet:
         print("Solver user:", user.address)
-        print("\tBalance:", fmt_algo(user.asa_balance(0)))
-    init_balance = user.asa_balance(0)
-    lowest_balance = user.asa_balance(0)
+        print("\tBalance:", fmt_algo(balances[0]))
 
     solution = Client.instantiate(Solution, test=args.example)
 
@@ -69,72 +84,94 @@ for day in args.day:
         if user.app_local_state(app):
             user.app_clear_state(app)
         stats["teal-size"] = "?"
+        session = Client.session(solution, user, app)
     else:
-        balance = user.asa_balance(0)
-        app, teal, stats_ = Client.create(solution, user, verbose=not args.quiet)
+        session = Client.session(solution, user)
+        teal, stats_ = session.create(verbose=not args.quiet)
 
         if args.teal:
             with open(f"{day}.teal", "w") as f:
                 f.write(teal)
 
         stats.update(stats_)
-        stats["cost_setup"] = (delta := balance - user.asa_balance(0))
+        stats["cost_setup"] = (delta := spent())
         if not args.quiet:
             print("Setup app cost:", fmt_algo(delta))
-        lowest_balance = min(lowest_balance, user.asa_balance(0))
 
-    balance = user.asa_balance(0)
     stats.update(
-        **Client.input(
-            solution, user, app, open(input_file).read(), verbose=not args.quiet
+        **session.input(
+            open(input_file).read(),
+            verbose=not args.quiet,
+            pipeline=args.pipeline,
         )
     )
-    stats["cost-input"] = (delta := balance - user.asa_balance(0))
+    stats["cost-input"] = (delta := spent())
     if not args.quiet:
         print("Input cost (incl box funding):", fmt_algo(delta))
-    lowest_balance = min(lowest_balance, user.asa_balance(0))
 
-    balance = user.asa_balance(0)
     stats.update(
-        **Client.solve(
-            solution,
-            user,
-            app,
+        **session.solve(
             verbose=not args.quiet,
             debug=args.debug,
             log=args.log or args.debug,
+            pipeline=args.pipeline,
         )
     )
-    stats["cost-solve"] = (delta := balance - user.asa_balance(0))
+    stats["cost-solve"] = (delta := spent())
     if not args.quiet:
         print("Solve cost:", fmt_algo(delta))
-    lowest_balance = min(lowest_balance, user.asa_balance(0))
 
-    stats.update(**Client.clear(solution, user, app, verbose=not args.quiet))
-    lowest_balance = min(lowest_balance, user.asa_balance(0))
+    stats.update(**session.clear(verbose=not args.quiet))
+    spent()
 
-    stats["cost-final"] = (delta := init_balance - user.asa_balance(0))
-    stats["funds"] = init_balance - lowest_balance
+    stats["cost-final"] = (delta := balances[0] - balances[-1])
+    stats["funds"] = balances[0] - min(balances)
     if not args.quiet:
         # print(stats)
-        print("Required algos to solve:", fmt_algo(init_balance - lowest_balance))
+        print("Required algos to solve:", fmt_algo(stats["funds"]))
         print("Final cost:", fmt_algo(delta))
 
-    day_stats.append(stats)
-
-for k in ["box-funds", "cost-final", "funds"]:
-    for r in day_stats:
-        r[k] = fmt_algo(r[k])
-
-headers = [
-    "day",
-    "input-size",
-    "teal-size",
-    "iters",
-    "opcode-budget",
-    "cost-final",
-    "funds",
-    "solutions",
-]
-day_stats = [[row[h] for h in headers] for row in day_stats]
-print(tabulate(day_stats, headers=headers))
+    return stats
+
+
+def main():
+    args = parser.parse_args()
+
+    if args.day > 0:
+        args.day = [args.day]
+    else:
+        args.day = list(range(1, -args.day + 1))
+
+    if args.jobs > 1 and (args.commit or user_pk is not None):
+        # The costs are read off the solver balance, which can't be shared
+        parser.error(
+            "--jobs needs a new solver account per worker, drop --commit/user_pk"
+        )
+
+    if args.jobs > 1:
+        # Days share nothing but the faucet: each worker gets its own solver and client
+        with ProcessPoolExecutor(args.jobs) as pool:
+            day_stats = list(pool.map(run_day, args.day, repeat(args)))
+    else:
+        day_stats = [run_day(day, args) for day in args.day]
+
+    for k in ["box-funds", "cost-final", "funds"]:
+        for r in day_stats:
+            r[k] = fmt_algo(r[k])
+
+    headers = [
+        "day",
+        "input-size",
+        "teal-size",
+        "iters",
+        "opcode-budget",
+        "cost-final",
+        "funds",
+        "solutions",
+    ]
+    day_stats = [[row[h] for h in headers] for row in day_stats]
+    print(tabulate(day_stats, headers=headers))
+
+
+if __name__ == "__main__":
+    main()
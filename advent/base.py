@@ -1,14 +1,23 @@
+import os
 import re
+import sys
+import json
+import hashlib
+import tempfile
+from importlib.metadata import version
+from pathlib import Path
 from types import SimpleNamespace
+from typing import Optional
 
 from pyteal import *
 from beaker import *
 from beaker.decorators import *
 from beaker.consts import TRUE, FALSE
-
-from algosdk.constants import MIN_TXN_FEE
+from algosdk.abi import Contract
 
 from .utils import SScratchVar, Min, Findi, wrap, Wrappable, Forever, Max, SLog
+from .utils import atoi_swar, MAX_BYTES
+from . import utils
 
 
 class SolveStatus(abi.NamedTuple):
@@ -22,6 +31,11 @@ DEFAULT_MEASUREMENT = "default"
 class Base(Application):
     TEAL_VERSION = 8
     READER_LINE_UNROLL = 10
+    # Bytes of input kept in scratch for the char by char readers, the last window
+    # gets 8 bytes of padding on top
+    READER_WINDOW = MAX_BYTES - 8
+    # Compiled programs are kept here across runs, None to always compile
+    TEAL_CACHE = Path(__file__).parent / ".." / ".teal-cache"
 
     name: Final[ApplicationStateValue] = ApplicationStateValue(
         stack_type=TealType.bytes,
@@ -39,6 +53,10 @@ class Base(Application):
     writer_index: Final[AccountStateValue] = AccountStateValue(
         stack_type=TealType.uint64,
     )
+    # Set once solve_impl signals completion, so extra (pipelined) solve calls are no-ops
+    solved: Final[AccountStateValue] = AccountStateValue(
+        stack_type=TealType.uint64,
+    )
     # Don't use this directly
     _reader_index: Final[AccountStateValue] = AccountStateValue(
         stack_type=TealType.uint64
@@ -60,6 +78,53 @@ class Base(Application):
         self.is_test = test
         super().__init__(self.TEAL_VERSION)
 
+    def compile(self, client=None):
+        # On a cache hit the PyTeal AST is never built
+        if self.approval_program is None and (cached := self.teal_cache_load()):
+            self.approval_program = cached["approval"]
+            self.clear_program = cached["clear"]
+            self.contract = Contract.undictify(cached["contract"])
+        if self.approval_program is None:
+            super().compile(client)
+            self.teal_cache_store(
+                approval=self.approval_program,
+                clear=self.clear_program,
+                contract=self.contract.dictify(),
+            )
+        return self.approval_program, self.clear_program
+
+    def teal_cache_file(self) -> Optional[Path]:
+        if self.TEAL_CACHE is None:
+            return None
+        root = Path(__file__).parent
+        key = hashlib.sha256()
+        for src in [
+            Path(sys.modules[self.__module__].__file__),
+            Path(__file__),
+            root / "utils.py",
+            *sorted((root / "third_party").glob("*.py")),
+        ]:
+            key.update(src.read_bytes())
+        flags = [self.is_test, utils.DEBUG, version("pyteal"), version("beaker-pyteal")]
+        key.update("/".join(map(str, flags)).encode())
+        return Path(self.TEAL_CACHE) / f"{self.__module__}-{key.hexdigest()}.json"
+
+    def teal_cache_load(self) -> dict:
+        path = self.teal_cache_file()
+        if path is None or not path.exists():
+            return {}
+        return json.loads(path.read_text())
+
+    def teal_cache_store(self, **entries):
+        if (path := self.teal_cache_file()) is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so concurrent runs never read a partial entry
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=path.parent)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(self.teal_cache_load() | entries))
+        os.replace(tmp, path)
+
     @create
     def create(self):
         day = re.match(r"^.+\._(\d+)", self.__module__).group(1)
@@ -172,6 +237,24 @@ class Base(Application):
     def work_box_size(self):
         return None
 
+    @internal(TealType.bytes)
+    def extra_box(self):
+        return Concat(self.user_addr32.get(), Bytes(":extra"))
+
+    def extra_box_size(self):
+        """A second work box, for days whose state doesn't fit in a single one."""
+        return None
+
+    def work_boxes(self):
+        return [
+            (box, size)
+            for box, size in (
+                (self.work_box, self.work_box_size()),
+                (self.extra_box, self.extra_box_size()),
+            )
+            if size is not None
+        ]
+
     @internal(TealType.uint64)
     def box_cost(self, size: Expr):
         return Int(2500) + Int(400) * (Int(64) + size)
@@ -179,8 +262,8 @@ class Base(Application):
     @internal(TealType.uint64)
     def box_funds(self):
         ret = self.box_cost(self.input_size.get())
-        if (work := self.work_box_size()) is not None:
-            ret = ret + self.box_cost(wrap(work))
+        for _, size in self.work_boxes():
+            ret = ret + self.box_cost(wrap(size))
         return ret
 
     @internal(TealType.none)
@@ -190,8 +273,8 @@ class Base(Application):
             self.writer_index.set(Int(0)),
             Pop(App.box_create(self.input_box(), self.input_size.get())),
         ]
-        if (work := self.work_box_size()) is not None:
-            ret.append(Pop(App.box_create(self.work_box(), wrap(work))))
+        for box, size in self.work_boxes():
+            ret.append(Pop(App.box_create(box(), wrap(size))))
         return Seq(ret)
 
     @opt_in
@@ -225,10 +308,10 @@ class Base(Application):
         ret = [(box := abi.String()).set(self.input_box())]
         boxes = [box]
         budget = self.input_size.get()
-        if (work := self.work_box_size()) is not None:
-            ret.append((box2 := abi.String()).set(self.work_box()))
+        for box_name, size in self.work_boxes():
+            ret.append((box2 := abi.String()).set(box_name()))
             boxes.append(box2)
-            budget = budget + wrap(work)
+            budget = budget + wrap(size)
         return Seq(
             *ret,
             (boxes_abi := abi.make(abi.DynamicArray[abi.String])).set(boxes),
@@ -237,13 +320,14 @@ class Base(Application):
         )
 
     @external
-    def input_append(self, chunk: abi.String, *, output: abi.Uint64):
+    def input_append(
+        self, offset: abi.Uint64, chunk: abi.DynamicBytes, *, output: abi.Uint64
+    ):
+        # NOTE: chunks carry their offset, so they can land in any order
         return Seq(
             If(Not(self.writer_index.exists())).Then(self.init_box()),
             (chunk_var := ScratchVar()).store(chunk.get()),
-            App.box_replace(
-                self.input_box(), self.writer_index.get(), chunk_var.load()
-            ),
+            App.box_replace(self.input_box(), offset.get(), chunk_var.load()),
             self.writer_index.increment(Len(chunk_var.load())),
             output.set(self.writer_index.get()),
         )
@@ -255,11 +339,13 @@ class Base(Application):
             Assert(
                 App.box_delete(self.input_box()), comment="Input box does not exists"
             ),
-            Assert(App.box_delete(self.work_box()), comment="Work box does not exists")
-            if self.work_box_size() is not None
-            else Seq(),
+            *[
+                Assert(App.box_delete(box()), comment="Work box does not exists")
+                for box, _ in self.work_boxes()
+            ],
             self.writer_index.delete(),
             self.input_size.delete(),
+            self.solved.delete(),
             InnerTxnBuilder.Execute(
                 {
                     TxnField.type_enum: TxnType.Payment,
@@ -281,7 +367,11 @@ class Base(Application):
     def reader_seek(self, read_index, no_cache=False):
         if no_cache:
             return self._reader_index.set(wrap(read_index))
-        return self.reader_index().store(read_index)
+        return Seq(
+            self.reader_index().store(read_index),
+            # May go back past the window start
+            self._cache_window_end.store(Int(0)),
+        )
 
     def reader_done(self):
         return self.reader_index().load() == self._cache_input_size.load()
@@ -292,6 +382,51 @@ class Base(Application):
     def reader_skip(self, count):
         return self.reader_index().inc(count)
 
+    def reader_fill(self, size: Expr):
+        """Make the window hold the next `size` bytes, or up to the end of the input.
+
+        The window is just a copy of the input box, so it's rebuilt on the first read
+        of each solve call and doesn't need to be saved with the work state."""
+        return If(
+            self.reader_index().load() + size > self._cache_window_end.load()
+        ).Then(
+            self._cache_window_start.store(self.reader_index().load()),
+            If(
+                self.reader_index().load() + Int(self.READER_WINDOW)
+                < self._cache_input_size.load()
+            )
+            .Then(
+                self._cache_window.store(
+                    App.box_extract(
+                        self._cache_box.load(),
+                        self.reader_index().load(),
+                        Int(self.READER_WINDOW),
+                    )
+                ),
+                self._cache_window_end.store(
+                    self.reader_index().load() + Int(self.READER_WINDOW)
+                ),
+            )
+            .Else(
+                # Padded, so 8 bytes can always be read from the last one
+                self._cache_window.store(
+                    Concat(
+                        App.box_extract(
+                            self._cache_box.load(),
+                            self.reader_index().load(),
+                            self.reader_remaining(),
+                        ),
+                        Bytes(b"\0" * 8),
+                    )
+                ),
+                # Holds the whole remaining input, never refill
+                self._cache_window_end.store(Int(2**64 - 1)),
+            ),
+        )
+
+    def reader_window_pos(self):
+        return self.reader_index().load() - self._cache_window_start.load()
+
     @internal(TealType.bytes)
     def reader_next(self, size: Expr):
         return Seq(
@@ -317,6 +452,7 @@ class Base(Application):
     def reader_next_line(self):
         # NOTE: trims the endline char
         ret = ScratchVar(TealType.bytes)
+        pos = SScratchVar(TealType.uint64)
         return Seq(
             If(self.reader_remaining() >= Int(self.READER_LINE_UNROLL))
             .Then(
@@ -341,15 +477,26 @@ class Base(Application):
                 self.reader_index().inc(self.READER_LINE_UNROLL),
             )
             .Else(ret.store(Bytes(""))),
+            # Scan the window for the newline, appending a window worth at a time
             Forever().Do(
-                (c := SScratchVar(TealType.bytes)).store(
-                    App.box_extract(
-                        self._cache_box.load(), self.reader_index().load(), Int(1)
+                self.reader_fill(Int(1)),
+                (start := SScratchVar(TealType.uint64)).store(self.reader_window_pos()),
+                (end := SScratchVar(TealType.uint64)).store(
+                    Len(self._cache_window.load())
+                ),
+                For(pos.store(start), pos < end, pos.inc()).Do(
+                    If(
+                        GetByte(self._cache_window.load(), pos.load()) == Int(ord("\n"))
+                    ).Then(Break())
+                ),
+                ret.store(
+                    Concat(
+                        ret.load(),
+                        Substring(self._cache_window.load(), start.load(), pos.load()),
                     )
                 ),
-                self.reader_index().inc(),
-                If(c == "\n").Then(Break()),
-                ret.store(Concat(ret.load(), c.load())),
+                self.reader_index().store(self._cache_window_start.load() + pos.load()),
+                If(pos < end).Then(self.reader_index().inc(), Break()),
             ),
             ret.load(),
         )
@@ -386,59 +533,77 @@ class Base(Application):
             ret.load(),
         )
 
-    @internal(TealType.uint64)
-    def reader_next_uint(self, output: ScratchVar):
-        c = SScratchVar(TealType.uint64)
-        next_char = Seq(
-            c.store(
-                GetByte(
-                    App.box_extract(
-                        self._cache_box.load(), self.reader_index().load(), Int(1)
+    # Enough for the sign and any uint64, even when parsed 8 digits at a time
+    READER_INT_SIZE = 1 + 3 * 8
+    # SWAR parsing costs about as much as 4 digits parsed one by one, so it only pays
+    # off for inputs with long numbers
+    READER_INT_SWAR = False
+
+    def reader_digits(self, pos: ScratchVar, acc: ScratchVar):
+        """Parse the window digits at `pos` into `acc`, moving `pos` past the terminator."""
+        if self.READER_INT_SWAR:
+            n = SScratchVar(TealType.uint64)
+            return Seq(
+                Forever().Do(
+                    # NOTE: atoi_swar goes first, as it sets `n`
+                    acc.store(
+                        atoi_swar(self._cache_window, pos.load(), n)
+                        + acc.load() * Exp(Int(10), n.load())
                     ),
-                    Int(0),
-                )
-            ),
-            self.reader_index().inc(),
+                    If(n < 8).Then(Break()),
+                    pos.inc(8),
+                ),
+                pos.inc(n.load() + Int(1)),
+            )
+        d = SScratchVar(TealType.uint64)
+        return Forever().Do(
+            d.store(self.reader_window_digit(pos)),
+            pos.inc(),
+            If(d >= 10).Then(Break()),
+            acc.store(acc.load() * Int(10) + d.load()),
         )
+
+    def reader_window_digit(self, pos: ScratchVar):
+        # A byte is a digit iff `byte ^ '0'` is below 10, so a single check is needed
+        return BitwiseXor(GetByte(self._cache_window.load(), pos.load()), Int(ord("0")))
+
+    def reader_sync(self, pos: ScratchVar):
+        return self.reader_index().store(self._cache_window_start.load() + pos.load())
+
+    @internal(TealType.uint64)
+    def reader_next_uint(self, output: ScratchVar):
+        pos = SScratchVar(TealType.uint64)
+        acc = SScratchVar(TealType.uint64)
+        # Digits are read from the window, the index is only synced at the end
         return Seq(
-            next_char,
-            If(Or(c < ord("0"), c > ord("9"))).Then(Return(FALSE)),
-            output.store(c - ord("0")),
-            Forever().Do(
-                next_char,
-                If(Or(c < ord("0"), c > ord("9"))).Then(Break()),
-                output.store(output.load() * Int(10) + (c - ord("0"))),
-            ),
+            self.reader_fill(Int(self.READER_INT_SIZE)),
+            pos.store(self.reader_window_pos()),
+            acc.store(self.reader_window_digit(pos)),
+            pos.inc(),
+            If(acc >= 10).Then(self.reader_sync(pos), Return(FALSE)),
+            self.reader_digits(pos, acc),
+            self.reader_sync(pos),
+            output.store(acc.load()),
             Return(TRUE),
         )
 
     @internal(TealType.uint64)
     def reader_next_int(self, output: ScratchVar, sign: ScratchVar):
-        c = SScratchVar(TealType.uint64)
-        next_char = Seq(
-            c.store(
-                GetByte(
-                    App.box_extract(
-                        self._cache_box.load(), self.reader_index().load(), Int(1)
-                    ),
-                    Int(0),
-                )
-            ),
-            self.reader_index().inc(),
-        )
+        pos = SScratchVar(TealType.uint64)
+        acc = SScratchVar(TealType.uint64)
         return Seq(
+            self.reader_fill(Int(self.READER_INT_SIZE)),
+            pos.store(self.reader_window_pos()),
             sign.store(Int(0)),
-            next_char,
-            If(c == ord("-"))
-            .Then(sign.store(Int(1)), output.store(Int(0)))
-            .ElseIf(Or(c < ord("0"), c > ord("9")))
-            .Then(Return(FALSE))
-            .Else(output.store(c - ord("0"))),
-            Forever().Do(
-                next_char,
-                If(Or(c < ord("0"), c > ord("9"))).Then(Break()),
-                output.store(output.load() * Int(10) + (c - ord("0"))),
-            ),
+            acc.store(self.reader_window_digit(pos)),
+            pos.inc(),
+            If(acc.load() == Int(ord("-") ^ ord("0")))
+            .Then(sign.store(Int(1)), acc.store(Int(0)))
+            .ElseIf(acc >= 10)
+            .Then(self.reader_sync(pos), Return(FALSE)),
+            self.reader_digits(pos, acc),
+            self.reader_sync(pos),
+            output.store(acc.load()),
             Return(TRUE),
         )
 
@@ -461,18 +626,33 @@ class Base(Application):
         self._cache_box = ScratchVar()
         self._cache_reader_index = SScratchVar()
         self._cache_input_size = ScratchVar()
+        self._cache_window = ScratchVar(TealType.bytes)
+        self._cache_window_start = ScratchVar(TealType.uint64)
+        self._cache_window_end = ScratchVar(TealType.uint64)
 
         return Seq(
+            If(self.solved.get()).Then(
+                (done := abi.Bool()).set(TRUE),
+                (no_budget := abi.Uint64()).set(Int(0)),
+                output.set(done, no_budget),
+                Return(),
+            ),
+            # The caller's fee decides how many inner calls to spend
             OpUp(OpUpMode.OnCall).maximize_budget(
-                Int(256 * MIN_TXN_FEE), OpUpFeeSource.GroupCredit
+                Txn.fee() - Global.min_txn_fee(), OpUpFeeSource.GroupCredit
             ),
             (init_budget := ScratchVar(TealType.uint64)).store(Global.opcode_budget()),
             Seq([x.store(0) for x in self.measurements.values()]),
             self._cache_box.store(self.input_box()),
             self._cache_reader_index.store(self._reader_index.get()),
             self._cache_input_size.store(self.input_size.get()),
+            # Empty window, filled by the first read
+            self._cache_window.store(Bytes("")),
+            self._cache_window_start.store(Int(0)),
+            self._cache_window_end.store(Int(0)),
             (solved := abi.Bool()).set(self.solve_impl()),
             self._reader_index.set(self._cache_reader_index.load()),
+            self.solved.set(solved.get()),
             Seq(
                 [
                     If(value.load()).Then(SLog(f"{key}:", value))
@@ -1,3 +1,4 @@
+from collections import deque
 from tqdm import tqdm
 import base64
 
@@ -5,10 +6,12 @@ from beaker import *
 
 from algosdk.atomic_transaction_composer import (
     AtomicTransactionComposer,
+    AtomicTransactionResponse,
     AccountTransactionSigner,
     TransactionWithSigner,
 )
 from algosdk import transaction
+from algosdk.error import AlgodHTTPError
 from algosdk.constants import MIN_TXN_FEE, TX_GROUP_LIMIT
 
 from .third_party.account import Account, AppAccount
@@ -16,7 +19,10 @@ from .base import Base
 from .utils import fmt_algo
 
 
-MAX_ARG_SIZE = 2048 - 4 - 2  # Method selector and abi encoding
+MAX_ARG_SIZE = 2048 - 4 - 2 - 8  # Method selector, abi encoding and offset
+MAX_GROUP_INNERS = 256  # Inner txns a whole group can issue
+BOX_REFS = 8  # Box references of each app call
+BOX_REF_QUOTA = 1024  # Box I/O bytes each reference adds to the group quota
 
 
 def chunk(data):
@@ -36,134 +42,219 @@ class ClientBase:
         return cls(test)
 
     @staticmethod
-    def create(sol: Base, user: Account, verbose=True):
-        app_client = client.ApplicationClient(
+    def encode_input(input: str) -> bytes:
+        """Bytes uploaded to the input box, days can pre-parse the text here."""
+        return input.encode()
+
+    @classmethod
+    def session(cls, sol: Base, user: Account, app: AppAccount = None):
+        return SolveSession(sol, user, app, encode_input=cls.encode_input)
+
+
+class SolveSession:
+    """The stages of one app instance, sharing its client, box refs and params."""
+
+    def __init__(
+        self,
+        sol: Base,
+        user: Account,
+        app: AppAccount = None,
+        encode_input=ClientBase.encode_input,
+    ):
+        self.sol = sol
+        self.user = user
+        self.app = app
+        self.encode_input = encode_input
+        self.app_client = client.ApplicationClient(
             client=user.algod_client,
             app=sol,
             signer=AccountTransactionSigner(user.private_key),
+            app_id=app.app_id if app else 0,
         )
+        self._boxes = None
+
+    def boxes(self):
+        """Input box names and box budget, known once the input size is set."""
+        if self._boxes is None:
+            self._boxes = self.app_client.call(self.sol.get_boxes).return_value
+            check_box_budget(self._boxes[1])
+        return self._boxes
+
+    def create(self, verbose=True):
+        # Reuse the assembled programs too, skipping the algod compile calls
+        if "approval_binary" in (cached := self.sol.teal_cache_load()):
+            self.app_client.approval_binary = base64.b64decode(
+                cached["approval_binary"]
+            )
+            self.app_client.clear_binary = base64.b64decode(cached["clear_binary"])
 
-        app_id, app_addr, _ = app_client.create()
+        app_id, app_addr, _ = self.app_client.create()
+        self.sol.teal_cache_store(
+            approval_binary=base64.b64encode(self.app_client.approval_binary).decode(),
+            clear_binary=base64.b64encode(self.app_client.clear_binary).decode(),
+        )
         if verbose:
             print(f"App ID: {app_id} | Address: {app_addr}")
-        app = AppAccount.from_app_id(app_id, algod_client=app_client.client)
+        self.app = AppAccount.from_app_id(app_id, algod_client=self.app_client.client)
 
-        assert (mb := app.algod_client.account_info(app.address)["min-balance"]) < 1e6
-        user.pay(app, mb)
+        assert (
+            mb := self.app.algod_client.account_info(self.app.address)["min-balance"]
+        ) < 1e6
+        self.user.pay(self.app, mb)
 
         return (
-            app,
-            app_client.app.compile()[0],
+            self.app_client.app.compile()[0],
             {
-                "teal-size": len(app_client.approval_binary)
-                + len(app_client.clear_binary)
+                "teal-size": len(self.app_client.approval_binary)
+                + len(self.app_client.clear_binary)
             },
         )
 
-    @staticmethod
-    def input(sol: Base, user: Account, app: AppAccount, input: str, verbose=True):
+    def input(self, input: str, verbose=True, pipeline=1):
         assert input.endswith("\n"), "Missing newline at the end, careful"
-
-        app_client = client.ApplicationClient(
-            client=user.algod_client,
-            app=sol,
-            signer=AccountTransactionSigner(user.private_key),
-            app_id=app.app_id,
-        )
+        input = self.encode_input(input)
 
         chunks = chunk(input)
         ret = {"input-size": len(input), "chunks": len(chunks)}
         if verbose:
             print(f"Input size: {len(input)}, {len(chunks)} chunks")
 
-        input_funds = app_client.call(
-            sol.opt_in,
-            sender_addr=user.address,
+        input_funds = self.app_client.call(
+            self.sol.opt_in,
+            sender_addr=self.user.address,
             input_size=len(input),
             on_complete=transaction.OnComplete.OptInOC,
         ).return_value
-        input_boxes, box_budget = app_client.call(sol.get_boxes).return_value
+        input_boxes, box_budget = self.boxes()
         # print(f"Input box: {input_box}")
         ret["box-funds"] = input_funds
         ret["box-budget"] = box_budget
-        app_client.call(
-            sol.deposit,
-            txn=TransactionWithSigner(
-                transaction.PaymentTxn(
-                    user.address,
-                    user._get_params(),
-                    app.address,
-                    input_funds,
+        with_fresh_params(
+            self.user,
+            lambda: self.app_client.call(
+                self.sol.deposit,
+                txn=TransactionWithSigner(
+                    transaction.PaymentTxn(
+                        self.user.address,
+                        self.user._get_params(),
+                        self.app.address,
+                        input_funds,
+                    ),
+                    self.user,
                 ),
-                user,
             ),
         )
-        atc = None
-        res = []
-        relevant_txn = None
-        for i, c in enumerate(chunks):
-            if atc is None:
-                atc = AtomicTransactionComposer()
 
-            app_client.add_method_call(
-                atc,
-                sol.input_append,
-                chunk=c,
-                boxes=boxes_fmt(input_boxes),
+        def input_group(i):
+            params = self.user._get_params()
+            atc = AtomicTransactionComposer()
+            for j, c in enumerate(chunks[i : i + TX_GROUP_LIMIT], i):
+                self.app_client.add_method_call(
+                    atc,
+                    self.sol.input_append,
+                    offset=j * MAX_ARG_SIZE,
+                    chunk=c,
+                    boxes=boxes_fmt(input_boxes),
+                    suggested_params=params,
+                )
+            ensure_box_budget(atc, self.app_client, self.sol.nop, box_budget, params)
+            atc.gather_signatures()
+            return atc
+
+        # Sign every group up front, then keep up to `pipeline` of them in flight
+        starts = range(0, len(chunks), TX_GROUP_LIMIT)
+        atcs = [input_group(i) for i in starts]
+
+        res = []
+        in_flight = deque()
+        for i, atc in zip(starts, atcs):
+            if len(in_flight) == pipeline:
+                res.extend(
+                    wait_atc(
+                        in_flight.popleft(), self.app_client.client, self.user
+                    ).abi_results
+                )
+            atc = submit_atc(
+                atc, self.app_client.client, self.user, lambda: input_group(i)
             )
-            if len(atc.txn_list) == TX_GROUP_LIMIT or i == len(chunks) - 1:
-                relevant_txn = len(atc.txn_list) - 1
-                ensure_box_budget(atc, app_client, sol.nop, box_budget)
-                res.extend(atc.execute(app_client.client, 0).abi_results)
-                atc = None
-        assert res[relevant_txn].return_value == len(input), "Stored input mismatch"
-
-        # print(user.app_local_state(app))
+            in_flight.append(atc)
+        for atc in in_flight:
+            res.extend(wait_atc(atc, self.app_client.client, self.user).abi_results)
+        written = max(r.return_value for r in res if r.return_value is not None)
+        assert written == len(input), "Stored input mismatch"
+
+        # print(self.user.app_local_state(self.app))
         ret.update(
             app_min_balance=(
-                min_balance := app.algod_client.account_info(app.address)["min-balance"]
+                min_balance := self.app.algod_client.account_info(self.app.address)[
+                    "min-balance"
+                ]
             )
         )
         if verbose:
             print("App min balance:", fmt_algo(min_balance))
         return ret
 
-    @staticmethod
     def solve(
-        sol: Base, user: Account, app: AppAccount, verbose=True, debug=False, log=False
+        self,
+        verbose=True,
+        debug=False,
+        log=False,
+        pipeline=1,
     ):
-        app_client = client.ApplicationClient(
-            client=user.algod_client,
-            app=sol,
-            signer=AccountTransactionSigner(user.private_key),
-            app_id=app.app_id,
-        )
-        input_boxes, box_budget = app_client.call(sol.get_boxes).return_value
+        input_boxes, box_budget = self.boxes()
 
-        total_budget = 0
-        for iters in tqdm(dummy_gen()):
+        # Keep up to `pipeline` solve groups in flight: they are applied in order on the
+        # saved state, and the ones submitted after the final one are no-ops
+        def solve_group():
             atc = AtomicTransactionComposer()
-            app_client.add_method_call(
+            self.app_client.add_method_call(
                 atc,
-                sol.solve,
+                self.sol.solve,
                 boxes=boxes_fmt(input_boxes),
-                suggested_params=user._get_params(fee=MIN_TXN_FEE * 257),
+                # The fee pays for the inner calls the OpUp spends
+                suggested_params=self.user._get_params(
+                    fee=MIN_TXN_FEE * (1 + MAX_GROUP_INNERS)
+                ),
+                note=f"solve:{submitted}",  # Avoid duplicated txns in flight
+            )
+            ensure_box_budget(
+                atc,
+                self.app_client,
+                self.sol.nop,
+                box_budget,
+                self.user._get_params(),
             )
-            ensure_box_budget(atc, app_client, sol.nop, box_budget)
-            atc_res = atc.execute(app_client.client, 0)
+            return atc
+
+        in_flight = deque()
+        submitted = 0
+        total_budget = 0
+        for iters in tqdm(dummy_gen()):
+            while len(in_flight) < pipeline:
+                atc = submit_atc(
+                    solve_group(), self.app_client.client, self.user, solve_group
+                )
+                in_flight.append(atc)
+                submitted += 1
+            atc_res = wait_atc(in_flight.popleft(), self.app_client.client, self.user)
+            # Only the solve calls return something
+            results = [r for r in atc_res.abi_results if r.return_value is not None]
 
             # Debug helper
             if log:
-                print(atc_res.abi_results[0].tx_info["logs"])
-                for log in atc_res.abi_results[0].tx_info["logs"][:-1]:
-                    print(base64.b64decode(log.encode()))
+                for r in results:
+                    print(r.tx_info["logs"])
+                    for log in r.tx_info["logs"][:-1]:
+                        print(base64.b64decode(log.encode()))
 
-            res = atc_res.abi_results[0].return_value
-            total_budget += res[1]
-            if res[0]:
+            total_budget += sum(r.return_value[1] for r in results)
+            if any(r.return_value[0] for r in results):
                 break
+        for atc in in_flight:
+            wait_atc(atc, self.app_client.client, self.user)
 
-        solutions = app_client.call(sol.get_solution).return_value
+        solutions = self.app_client.call(self.sol.get_solution).return_value
         if verbose:
             print("Total budget consumed:", total_budget)
             print("Solution:", solutions)
@@ -173,39 +264,98 @@ class ClientBase:
             "solutions": solutions,
         }
 
-    @staticmethod
-    def clear(sol: Base, user: Account, app: AppAccount, verbose=True):
-        app_client = client.ApplicationClient(
-            client=user.algod_client,
-            app=sol,
-            signer=AccountTransactionSigner(user.private_key),
-            app_id=app.app_id,
-        )
-        input_boxes, box_budget = app_client.call(sol.get_boxes).return_value
+    def clear(self, verbose=True):
+        input_boxes, box_budget = self.boxes()
 
-        atc = AtomicTransactionComposer()
-        app_client.add_method_call(
-            atc,
-            sol.input_clear,
-            boxes=boxes_fmt(input_boxes),
-            suggested_params=user._get_params(fee=MIN_TXN_FEE * 2),
+        def clear_group():
+            atc = AtomicTransactionComposer()
+            self.app_client.add_method_call(
+                atc,
+                self.sol.input_clear,
+                boxes=boxes_fmt(input_boxes),
+                suggested_params=self.user._get_params(fee=MIN_TXN_FEE * 2),
+            )
+            ensure_box_budget(
+                atc, self.app_client, self.sol.nop, box_budget, self.user._get_params()
+            )
+            return atc
+
+        atc = submit_atc(clear_group(), self.app_client.client, self.user, clear_group)
+        res = (
+            wait_atc(atc, self.app_client.client, self.user).abi_results[0].return_value
         )
-        ensure_box_budget(atc, app_client, sol.nop, box_budget)
-        res = atc.execute(app_client.client, 0).abi_results[0].return_value
 
         if verbose:
             print("Input close reclaimed:", fmt_algo(res))
         return {"reclaimed": res}
 
 
-def ensure_box_budget(atc, app_client, fn, budget):
-    budget -= sum(len(txn.txn.boxes) * 1024 for txn in atc.txn_list)
+def ensure_box_budget(atc, app_client, fn, budget, suggested_params=None):
+    budget -= sum(len(txn.txn.boxes) * BOX_REF_QUOTA for txn in atc.txn_list)
     for i in range(len(atc.txn_list), TX_GROUP_LIMIT - 1):
         if budget <= 0:
             break
-        app_client.add_method_call(atc, fn, boxes=[[0, ""]] * 8, note=str(i))
-        budget -= 1024 * 8
+        app_client.add_method_call(
+            atc,
+            fn,
+            boxes=[[0, ""]] * BOX_REFS,
+            note=str(i),
+            suggested_params=suggested_params,
+        )
+        budget -= BOX_REF_QUOTA * BOX_REFS
+
+
+def check_box_budget(box_budget):
+    """Make sure the txns `ensure_box_budget` can fill a group with cover the budget."""
+    txns = -(-box_budget // (BOX_REFS * BOX_REF_QUOTA))
+    if txns > TX_GROUP_LIMIT - 1:
+        raise ValueError(f"A box budget of {box_budget} bytes doesn't fit in a group")
 
 
 def boxes_fmt(input_boxes):
-    return [[0, i] for i in input_boxes] + [[0, ""]] * (8 - len(input_boxes))
+    return [[0, i] for i in input_boxes] + [[0, ""]] * (BOX_REFS - len(input_boxes))
+
+
+def with_fresh_params(user: Account, fn):
+    """Call `fn`, once more if the cached params fell out of their validity window."""
+    try:
+        return fn()
+    except AlgodHTTPError as err:
+        if not user.params_expired(err):
+            raise
+        return fn()
+
+
+def submit_atc(atc: AtomicTransactionComposer, algod_client, user: Account, rebuild):
+    """`atc.submit`, retried once on a `rebuild()` group if the params expired."""
+    try:
+        atc.submit(algod_client)
+    except AlgodHTTPError as err:
+        if not user.params_expired(err):
+            raise
+        atc = rebuild()
+        atc.submit(algod_client)
+    return atc
+
+
+def wait_atc(
+    atc: AtomicTransactionComposer, algod_client, user: Account = None, wait_rounds=0
+):
+    """Like `atc.execute`, but for a group already sent with `atc.submit`."""
+    confirmed_round = transaction.wait_for_confirmation(
+        algod_client, atc.tx_ids[0], wait_rounds
+    )["confirmed-round"]
+    if user is not None:
+        user.observe_round(confirmed_round)
+    return AtomicTransactionResponse(
+        confirmed_round=confirmed_round,
+        tx_ids=atc.tx_ids,
+        results=[
+            atc.parse_result(
+                method,
+                atc.tx_ids[i],
+                algod_client.pending_transaction_info(atc.tx_ids[i]),
+            )
+            for i, method in atc.method_dict.items()
+        ],
+    )
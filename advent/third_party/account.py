@@ -22,11 +22,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import copy
 import dataclasses
 import base64
-from typing import Any, Optional, Union, cast
+from typing import Any, ClassVar, Optional, Union, cast
 
 import algosdk
+from algosdk import constants
 from algosdk import encoding
 from algosdk import transaction
 from algosdk.v2client import algod
@@ -50,6 +52,11 @@ class Account(TransactionSigner):
     address: str
     private_key: Optional[str] = None
     algod_client: Optional[algod.AlgodClient] = None
+    # Suggested params are fetched again only once they're this many rounds old
+    PARAMS_REFRESH_ROUNDS: ClassVar[int] = 100
+    _params: dict = dataclasses.field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
 
     @classmethod
     def create(cls, **kwargs) -> "Account":
@@ -90,20 +97,43 @@ class Account(TransactionSigner):
         try:
             self.algod_client.send_transactions([signed_txn])
 
-            transaction.wait_for_confirmation(self.algod_client, tx_id)
+            confirmed = transaction.wait_for_confirmation(self.algod_client, tx_id)
+            self.observe_round(confirmed["confirmed-round"])
 
             return self.algod_client.pending_transaction_info(tx_id)
 
         except algosdk.error.AlgodHTTPError as err:
+            self.params_expired(err)
             drr = transaction.create_dryrun(self.algod_client, [signed_txn])
             filename = "dryrun.msgp"
             with open(filename, "wb") as f:
                 f.write(base64.b64decode(encoding.msgpack_encode(drr)))
             raise err
 
-    def _get_params(self, *args, **kwargs) -> transaction.SuggestedParams:
+    def _get_params(self, fee: int = None) -> transaction.SuggestedParams:
+        """Suggested params with a flat `fee`, all derived from one cached base."""
         assert self.algod_client
-        return get_params(self.algod_client, *args, **kwargs)
+        cached = self._params
+        if "base" not in cached or (
+            cached["round"] >= cached["base"].first + self.PARAMS_REFRESH_ROUNDS
+        ):
+            cached["base"] = get_params(self.algod_client)
+            cached["round"] = cached["base"].first
+        params = copy.copy(cached["base"])
+        params.fee = fee or constants.MIN_TXN_FEE
+        return params
+
+    def params_expired(self, err: Exception) -> bool:
+        """Drop the cached params if `err` says a txn is outside its validity window."""
+        if "txn dead" in str(err):
+            self._params.clear()
+            return True
+        return False
+
+    def observe_round(self, round: int):
+        """Track the last known round, to tell when the cached params get old."""
+        if "round" in self._params:
+            self._params["round"] = max(self._params["round"], round)
 
     def pay(self, receiver: Union["Account", "AppAccount"], amount: int):
         txn = transaction.PaymentTxn(
@@ -170,6 +200,7 @@ class Account(TransactionSigner):
             return logged_result.return_value
 
         except algosdk.error.AlgodHTTPError as err:
+            self.params_expired(err)
             drr = transaction.create_dryrun(self.algod_client, atc.signed_txns)
             filename = "dryrun.msgp"
             with open(filename, "wb") as f:
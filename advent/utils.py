@@ -15,6 +15,7 @@ user_pk = None
 
 
 DEBUG = False
+MAX_BYTES = 4096  # Longest byte string on the stack
 
 
 def fmt_algo(amount):
@@ -47,6 +48,29 @@ def wrap(value: Wrappable):
     return value
 
 
+def fold_add(a: Wrappable, b: Wrappable) -> Wrappable:
+    """`a + b`, folded when compiling if any of them is a constant int: box offsets
+    mostly are, and each one saved is an op on every box access."""
+    if isinstance(a, int) and isinstance(b, int):
+        return a + b
+    if isinstance(a, int) and a == 0:
+        return b
+    if isinstance(b, int) and b == 0:
+        return a
+    return wrap(a) + wrap(b)
+
+
+def fold_mul(a: Wrappable, b: Wrappable) -> Wrappable:
+    """`a * b`, folded like `fold_add`"""
+    if isinstance(a, int) and isinstance(b, int):
+        return a * b
+    if isinstance(a, int) and a == 1:
+        return b
+    if isinstance(b, int) and b == 1:
+        return a
+    return wrap(a) * wrap(b)
+
+
 class WSubroutine:
     def __init__(self, *args, **kwargs) -> None:
         self.args = args
@@ -137,16 +161,85 @@ def digit_to_int(digit: Expr):
     return GetByte(digit, Int(0)) - Int(ord("0"))
 
 
+# SWAR: the 8 bytes of a uint64 used as lanes, this has 1 in each of them
+SWAR_LANES = 0x0101010101010101
+
+
+def swar_bcd(digits: Expr):
+    """Value of up to 8 digits, one per byte (0-9, big-endian, right aligned)."""
+    x = SScratchVar(TealType.uint64)
+    return Seq(
+        x.store(digits),
+        # Merge the lanes pairwise: 2 digits per 16 bits, 4 per 32 bits, then all 8
+        x.store(
+            BitwiseAnd(
+                ShiftRight(x.load(), Int(8)) * Int(10) + x.load(),
+                Int(0x00FF * 0x0001000100010001),
+            )
+        ),
+        x.store(
+            BitwiseAnd(
+                ShiftRight(x.load(), Int(16)) * Int(100) + x.load(),
+                Int(0xFFFF * 0x0000000100000001),
+            )
+        ),
+        BitwiseAnd(
+            ShiftRight(x.load(), Int(32)) * Int(10000) + x.load(), Int(0xFFFFFFFF)
+        ),
+    )
+
+
+def atoi_swar(buffer: ScratchVar, start: Expr, length: ScratchVar):
+    """Parse the leading digits of the 8 bytes at `start`, storing how many in `length`.
+
+    `buffer` must hold 8 bytes from `start`, ASCII only; `start` is evaluated twice."""
+    x = SScratchVar(TealType.uint64)
+    return Seq(
+        x.store(
+            BitwiseXor(ExtractUint64(buffer.load(), start), Int(0x30 * SWAR_LANES))
+        ),
+        # Only digits have both nibbles below 10 once xor-ed with "0", the first lane
+        # with a high nibble bit set once 6 is added is where the digits end
+        length.store(
+            (
+                Int(64)
+                - BitLen(
+                    BitwiseAnd(
+                        BitwiseOr(x.load(), x.load() + Int(0x06 * SWAR_LANES)),
+                        Int(0xF0 * SWAR_LANES),
+                    )
+                )
+            )
+            / Int(8)
+        ),
+        swar_bcd(
+            BitwiseAnd(
+                Btoi(Extract(buffer.load(), start, length.load())),
+                Int(0x0F * SWAR_LANES),
+            )
+        ),
+    )
+
+
 @WSubroutine(TealType.uint64)
 def atoi(s: Expr):
+    # NOTE: `s` must be all digits, they're converted 8 at a time
     return Seq(
         (ret := ScratchVar()).store(Int(0)),
         For(
             (i := ScratchVar()).store(Int(0)),
             i.load() < Len(s),
-            i.store(i.load() + Int(1)),
+            i.store(i.load() + (n := ScratchVar()).load()),
         ).Do(
-            ret.store(ret.load() * Int(10) + (GetByte(s, i.load()) - Int(ord("0")))),
+            n.store(If(Len(s) - i.load() < Int(8), Len(s) - i.load(), Int(8))),
+            ret.store(
+                ret.load() * Exp(Int(10), n.load())
+                + swar_bcd(
+                    BitwiseAnd(
+                        Btoi(Extract(s, i.load(), n.load())), Int(0x0F * SWAR_LANES)
+                    )
+                )
+            ),
         ),
         ret.load(),
     )
@@ -326,6 +419,43 @@ def AndShort(*args: Expr):
     return If(args[0]).Then(AndShort(*args[1:])).Else(Int(0))
 
 
+def itob_n(value: Expr, size: int):
+    """Big-endian `size` bytes of `value`, which must fit them."""
+    if size == 8:
+        return Itob(value)
+    return Extract(Itob(value), Int(8 - size), Int(size))
+
+
+def btoi_at(data: Expr, start: Wrappable, size: int):
+    """The `size` bytes big-endian uint at `start` of `data`."""
+    ops = {2: ExtractUint16, 4: ExtractUint32, 8: ExtractUint64}
+    if size in ops:
+        return ops[size](data, wrap(start))
+    if size == 1:
+        return GetByte(data, wrap(start))
+    return Btoi(Extract(data, wrap(start), Int(size)))
+
+
+def BitCount(data: Expr, size: int):
+    """Set bits in the first `size` bytes of `data`, 8 bytes at a time."""
+    count = SScratchVar(TealType.uint64)
+    v = SScratchVar(TealType.uint64)
+    ret = [count.store(0)]
+    for start in range(0, size, 8):
+        ret += [
+            v.store(btoi_at(data, start, min(8, size - start))),
+            v.store(v - ((v.load() >> Int(1)) & Int(0x5555555555555555))),
+            v.store(
+                (v.load() & Int(0x3333333333333333))
+                + ((v.load() >> Int(2)) & Int(0x3333333333333333))
+            ),
+            v.store((v + (v.load() >> Int(4))) & Int(0x0F0F0F0F0F0F0F0F)),
+            # The bytes sum up to 64 at most, 256 == 1 (mod 255)
+            count.inc(v % 255),
+        ]
+    return Seq(*ret, count.load())
+
+
 class BoxArea:
     def __init__(self, box_name: Wrappable, start: Wrappable, size: Wrappable):
         self.box_name = box_name
@@ -359,7 +489,7 @@ class BoxArea:
         else:
             ret.append(
                 App.box_extract(
-                    wrap(self.box_name), wrap(self.start) + wrap(start), wrap(length)
+                    wrap(self.box_name), wrap(fold_add(self.start, start)), wrap(length)
                 )
             )
         return Seq(ret)
@@ -390,7 +520,7 @@ class BoxArea:
         else:
             ret.append(
                 App.box_replace(
-                    wrap(self.box_name), wrap(self.start) + wrap(start), wrap(value)
+                    wrap(self.box_name), wrap(fold_add(self.start, start)), wrap(value)
                 )
             )
         return Seq(ret)
@@ -398,6 +528,16 @@ class BoxArea:
     def copy(self, src: "BoxArea"):
         return self.replace(0, src.extract(0, src.size))
 
+    def fill(self, byte: int = 0):
+        """Set the whole area to `byte` (0 or 255), with the largest writes allowed."""
+        if byte not in (0, 255):
+            raise NotImplementedError(f"Cannot fill with {byte}, only 0 and 255")
+        ret = []
+        for start in range(0, self.size, MAX_BYTES):
+            chunk = BytesZero(Int(min(MAX_BYTES, self.size - start)))
+            ret.append(self.replace(start, BytesNot(chunk) if byte else chunk))
+        return Seq(ret)
+
     def cache(self, skip_access_check=False):
         if not self.cached:
             self.cached = SScratchVar()
@@ -446,6 +586,8 @@ class BoxSlot:
 
 def BoxSlotCustom(encode, decode):
     class _BoxSlot(BoxSlot):
+        encoder = staticmethod(encode)
+
         def get(self):
             return decode(super().get())
 
@@ -458,11 +600,51 @@ def BoxSlotCustom(encode, decode):
 BoxSlotUint = BoxSlotCustom(Itob, Btoi)
 
 
+def BoxSlotUintN(size: int):
+    """Slot of a `size` bytes uint, the value must fit them."""
+    if size == 8:
+        return BoxSlotUint
+
+    def encode(value: Expr):
+        if DEBUG:
+            return Seq(
+                (tmp := SScratchVar()).store(value),
+                Assert(tmp < 2 ** (8 * size), comment="Uint overflow"),
+                itob_n(tmp.load(), size),
+            )
+        return itob_n(value, size)
+
+    return BoxSlotCustom(encode, Btoi)
+
+
+@dataclass(frozen=True)
+class StructInt:
+    """Struct field type of a `size` bytes uint, `Int` being `Int64`."""
+
+    size: int
+
+
+Int8 = StructInt(1)
+Int16 = StructInt(2)
+Int32 = StructInt(4)
+Int64 = StructInt(8)
+
+
 @dataclass
 class BoxSlotStructEntry:
     start: int
     length: int
     slot_cls: type
+    uint: bool = False
+
+    def encode(self, value: Wrappable):
+        return getattr(self.slot_cls, "encoder", wrap)(wrap(value))
+
+    def decode(self, data: Expr):
+        """The field value out of the bytes of the whole record."""
+        if not self.uint:
+            return Extract(data, Int(self.start), Int(self.length))
+        return btoi_at(data, self.start, self.length)
 
 
 _U = TypeVar("_U")
@@ -472,11 +654,40 @@ class BoxSlotStruct(BoxSlot, Generic[_U]):
     __slot_struct__ = None
 
     def __getattr__(self, name: str) -> BoxSlot | BoxSlotUint:
+        slot = self._entry(name)
+        return slot.slot_cls(self.area, fold_add(self.start, slot.start), slot.length)
+
+    def _entry(self, name: str) -> BoxSlotStructEntry:
         self._require_struct()
         if name not in self.__slot_struct__:
             raise AttributeError(f"Cannot find struct field {name}")
-        slot = self.__slot_struct__[name]
-        return slot.slot_cls(self.area, self.start + wrap(slot.start), slot.length)
+        return self.__slot_struct__[name]
+
+    def record(self) -> "BoxStructRecord[_U]":
+        return BoxStructRecord(self)
+
+    def set_fields(self, **values: Wrappable):
+        """Write the given fields, each run of adjacent ones with a single replace."""
+        self._require_struct()
+        for name in values:
+            self._entry(name)
+        ret = []
+        run = []
+        for name, entry in list(self.__slot_struct__.items()) + [(None, None)]:
+            if name in values:
+                run.append(entry.encode(values[name]))
+                if len(run) == 1:
+                    start = entry.start
+                continue
+            if run:
+                ret.append(
+                    self.area.replace(
+                        fold_add(self.start, start),
+                        Concat(*run) if len(run) > 1 else run[0],
+                    )
+                )
+                run = []
+        return Seq(ret)
 
     @classmethod
     def _size(cls, struct_cls):
@@ -490,12 +701,16 @@ class BoxSlotStruct(BoxSlot, Generic[_U]):
             if field.startswith("__"):
                 continue
             tp = getattr(struct_cls, field)
-            if field in ("area", "start", "length"):
+            if field in ("area", "start", "length", "record", "set_fields"):
                 raise ValueError(
                     f"Struct field `{field}` of `{struct_cls}` shadows a slot element and cannot be used."
                 )
             if tp == Int:
-                slot = BoxSlotStructEntry(start, 8, BoxSlotUint)
+                tp = Int64
+            if isinstance(tp, StructInt):
+                slot = BoxSlotStructEntry(
+                    start, tp.size, BoxSlotUintN(tp.size), uint=True
+                )
             elif tp[0] == Bytes:
                 slot = BoxSlotStructEntry(start, tp[1], BoxSlot)
             else:
@@ -510,6 +725,21 @@ class BoxSlotStruct(BoxSlot, Generic[_U]):
         self.__slot_struct__ = self._compute_struct(get_args(self.__orig_class__)[0])
 
 
+class BoxStructRecord(Generic[_U]):
+    """Scratch copy of a struct element: `load` reads it with a single access, then
+    its fields are decoded from there."""
+
+    def __init__(self, slot: BoxSlotStruct[_U]):
+        self.slot = slot
+        self.buffer = SScratchVar(TealType.bytes)
+
+    def load(self):
+        return self.buffer.store(self.slot.get())
+
+    def __getattr__(self, name: str) -> Expr:
+        return self.slot._entry(name).decode(self.buffer.load())
+
+
 _T = TypeVar("_T")
 
 
@@ -533,7 +763,7 @@ class BoxArrayBase(Generic[_T]):
                 Assert(tmp < self.capacity, comment="Overflowed array capacity"),
                 tmp * self.element_size,
             )
-        return wrap(index) * wrap(self.element_size)
+        return fold_mul(index, self.element_size)
 
     def __getitem__(self, index: Wrappable) -> _T:
         return self.slot_cls(self.area, self._index(index), self.element_size)
@@ -577,6 +807,173 @@ class BoxArrayStruct(BoxArrayBase[BoxSlotStruct[_T]], Generic[_T]):
         return BoxSlotStruct._size(cls)
 
 
+class BoxArrayEpoch(BoxArrayBase[BoxSlot]):
+    """`BoxArray` whose entries are tagged with the epoch they were written in.
+
+    Entries written before the last `reset` read as `default`, so resetting is O(1)
+    and nothing needs to be filled in beforehand: a zeroed area is all stale. The epoch
+    is kept in the box, add the array to the cached list. Tags are `tag_size` bytes,
+    the area is cleared when they wrap around."""
+
+    def __init__(
+        self,
+        allocator: BoxAllocator,
+        element_size: int,
+        capacity: int,
+        default: Optional[bytes] = None,
+        tag_size: int = 1,
+        cache_area: bool = False,
+    ):
+        self.epoch = SScratchVar(TealType.uint64)
+        self.state = BoxScratchStore(allocator, self.epoch)
+        self.default = b"\0" * element_size if default is None else default
+        self.tag_size = tag_size
+        self.cache_area = cache_area
+        if len(self.default) != element_size:
+            raise ValueError(f"Default must be {element_size} bytes")
+
+        array = self
+
+        class _BoxSlot(BoxSlot):
+            def get(self):
+                return array._get(wrap(self.start))
+
+            def set(self, value: Wrappable):
+                return super().set(
+                    Concat(itob_n(array.epoch.load(), tag_size), wrap(value))
+                )
+
+        super().__init__(
+            allocator, tag_size + element_size, capacity, slot_cls=_BoxSlot
+        )
+
+        @Subroutine(TealType.bytes)
+        def get(start_: Expr):
+            return Seq(
+                (tmp := SScratchVar()).store(
+                    self.area.extract(start_, self.element_size)
+                ),
+                If(btoi_at(tmp.load(), 0, tag_size) == self.epoch.load())
+                .Then(Suffix(tmp.load(), Int(tag_size)))
+                .Else(Bytes(self.default)),
+            )
+
+        self._get = get
+
+    def init(self):
+        return self.epoch.store(Int(1))
+
+    def cache(self):
+        return Seq(self.state.cache(), self.area.cache() if self.cache_area else Seq())
+
+    def flush(self):
+        return Seq(self.state.flush(), self.area.flush() if self.cache_area else Seq())
+
+    def reset(self):
+        return (
+            If(self.epoch.load() < Int(256**self.tag_size - 1))
+            .Then(self.epoch.inc())
+            .Else(self.area.fill(), self.epoch.store(Int(1)))
+        )
+
+
+class BoxGrid:
+    """`width` x `height` grid of `cell_bits` (1, 8 or 16) bits uint cells in a box area.
+
+    Cells are stored a row after the other, or a column after the other with
+    `column_major`. These lines are read and written whole with `line`, so neighbours
+    are worked on in scratch and lines combined with the byte string ops, or one at a
+    time with `load` and `store`."""
+
+    def __init__(
+        self,
+        allocator: BoxAllocator,
+        width: int,
+        height: int,
+        cell_bits: int = 8,
+        column_major: bool = False,
+    ):
+        if cell_bits not in (1, 8, 16):
+            raise NotImplementedError(f"Cells of {cell_bits} bits are not supported")
+        self.width = width
+        self.height = height
+        self.cell_bits = cell_bits
+        self.column_major = column_major
+        self.line_cells, self.lines = (
+            (height, width) if column_major else (width, height)
+        )
+        self.line_size = (self.line_cells * cell_bits + 7) // 8
+        self.area = allocator.alloc(self.line_size * self.lines)
+        self.buffer = SScratchVar(TealType.bytes)
+
+    def cache(self):
+        return self.area.cache()
+
+    def flush(self):
+        return self.area.flush()
+
+    def _split(self, x: Wrappable, y: Wrappable):
+        return (x, y) if self.column_major else (y, x)
+
+    def line(self, index: Wrappable) -> BoxSlot:
+        return BoxSlot(self.area, fold_mul(index, self.line_size), self.line_size)
+
+    def load(self, index: Wrappable):
+        return self.buffer.store(self.line(index).get())
+
+    def store(self, index: Wrappable):
+        return self.line(index).set(self.buffer.load())
+
+    def cell(self, pos: Wrappable, line: Optional[Expr] = None):
+        """Cell `pos` of the `line` bytes, the loaded one by default."""
+        line = self.buffer.load() if line is None else line
+        if self.cell_bits == 1:
+            return GetBit(line, wrap(pos))
+        if self.cell_bits == 8:
+            return GetByte(line, wrap(pos))
+        return ExtractUint16(line, wrap(fold_mul(pos, 2)))
+
+    def with_cell(self, pos: Wrappable, value: Wrappable, line: Optional[Expr] = None):
+        """The `line` bytes, the loaded one by default, with cell `pos` set."""
+        line = self.buffer.load() if line is None else line
+        if self.cell_bits == 1:
+            return SetBit(line, wrap(pos), wrap(value))
+        if self.cell_bits == 8:
+            return SetByte(line, wrap(pos), wrap(value))
+        return Replace(line, wrap(fold_mul(pos, 2)), itob_n(wrap(value), 2))
+
+    def set_cell(self, pos: Wrappable, value: Wrappable):
+        """Set cell `pos` of the loaded line."""
+        return self.buffer.store(self.with_cell(pos, value))
+
+    def get(self, x: Wrappable, y: Wrappable):
+        line, pos = self._split(x, y)
+        start = fold_mul(line, self.line_size)
+        if self.cell_bits == 1:
+            return GetBit(
+                self.area.extract(fold_add(start, wrap(pos) / Int(8)), 1),
+                wrap(pos) % Int(8),
+            )
+        size = self.cell_bits // 8
+        return Btoi(self.area.extract(fold_add(start, fold_mul(pos, size)), size))
+
+    def set(self, x: Wrappable, y: Wrappable, value: Wrappable):
+        line, pos = self._split(x, y)
+        start = fold_mul(line, self.line_size)
+        if self.cell_bits == 1:
+            return Seq(
+                (tmp := SScratchVar()).store(fold_add(start, wrap(pos) / Int(8))),
+                self.area.replace(
+                    tmp,
+                    SetBit(self.area.extract(tmp, 1), wrap(pos) % Int(8), wrap(value)),
+                ),
+            )
+        size = self.cell_bits // 8
+        return self.area.replace(
+            fold_add(start, fold_mul(pos, size)), itob_n(wrap(value), size)
+        )
+
+
 class BoxScratchStore:
     def __init__(
         self, allocator: BoxAllocator, *args: ScratchVar | tuple[ScratchVar, int]
@@ -622,32 +1019,587 @@ class BoxScratchStore:
             ]
         )
 
-    def cache(self, cache_area=True):
+    def cache(self):
+        # Read at once, but the scratch vars are the only copy: the area isn't cached,
+        # so flushes write straight to the box and never leave a stale cache behind
+        raw = SScratchVar(TealType.bytes)
+        return Seq(
+            raw.store(self.area.extract(0, self.area.size)),
+            Seq(
+                [
+                    arg.store(
+                        ExtractUint64(raw.load(), Int(slot.start))
+                        if isinstance(slot, BoxSlotUint)
+                        else Extract(raw.load(), Int(slot.start), Int(slot.length))
+                    )
+                    for arg, slot in zip(self.args, self.slots)
+                ]
+            ),
+        )
+
+    def flush(self):
+        # Adjacent ints are written at once
+        ret = []
+        ints = []
+        for arg, slot in list(zip(self.args, self.slots)) + [(None, None)]:
+            if isinstance(slot, BoxSlotUint):
+                ints.append((arg, slot))
+                continue
+            if ints:
+                ret.append(
+                    self.area.replace(
+                        ints[0][1].start,
+                        Concat(*[Itob(x.load()) for x, _ in ints])
+                        if len(ints) > 1
+                        else Itob(ints[0][0].load()),
+                    )
+                )
+                ints = []
+            if slot is not None:
+                ret.append(self.area.replace(slot.start, arg.load()))
+        return Seq(ret)
+
+
+class BoxHashSet:
+    """Open addressing set of uint keys, with linear probing over a box area.
+
+    Keys are stored plus one in `key_size` bytes, as 0 marks the empty slots, so they
+    must be below `256**key_size - 1`. Inserting in a full set fails."""
+
+    def __init__(
+        self,
+        allocator: BoxAllocator,
+        capacity: int,
+        key_size: int = 8,
+        *,
+        _value_size: int = 0,
+    ):
+        self.capacity = capacity
+        self.key_size = key_size
+        self.slot_size = key_size + _value_size
+        self.area = allocator.alloc(self.slot_size * capacity)
+        self.index = SScratchVar(TealType.uint64)
+        self.found = SScratchVar(TealType.uint64)
+        # Slots not probed yet, 0 once the whole set was
+        self.left = SScratchVar(TealType.uint64)
+
+        # Subroutines, as the probing loop inlined in other loops is too much for pyteal
+        @Subroutine(TealType.uint64)
+        def lookup(key_: Expr):
+            return Seq(
+                (key := SScratchVar(TealType.uint64)).store(key_ + Int(1)),
+                self._probe(key),
+                self.found.load(),
+            )
+
+        @Subroutine(TealType.uint64)
+        def insert(key_: Expr):
+            return Seq(
+                (key := SScratchVar(TealType.uint64)).store(key_ + Int(1)),
+                self._probe(key),
+                If(self.found.load()).Then(Return(Int(0))),
+                Assert(self.left.load(), comment="Hash set is full"),
+                self._set_key(key.load()),
+                Int(1),
+            )
+
+        self._lookup = lookup
+        self._insert = insert
+
+    def hash(self, key: Expr):
+        # Multiplicative hashing of the key folded to 32 bits, whose high bits are then
+        # scaled to the capacity: close keys end up far apart, whatever the capacity
+        tmp = SScratchVar(TealType.uint64)
         return Seq(
-            self.area.cache() if cache_area else Seq(),
-            Seq([arg.store(slot.get()) for arg, slot in zip(self.args, self.slots)]),
+            tmp.store(key),
+            tmp.store(tmp.load() ^ ShiftRight(tmp.load(), Int(32)))
+            if self.key_size > 4
+            else Seq(),
+            tmp.store(
+                BitwiseAnd(
+                    BitwiseAnd(tmp.load(), Int(0xFFFFFFFF)) * Int(0x9E3779B1),
+                    Int(0xFFFFFFFF),
+                )
+            ),
+            ShiftRight(tmp.load() * Int(self.capacity), Int(32)),
         )
 
-    def flush(self, flush_area=True):
+    def _key_at(self, index: Expr):
+        return Btoi(self.area.extract(fold_mul(index, self.slot_size), self.key_size))
+
+    def _probe(self, key: ScratchVar):
+        """Look for the stored `key`, leaving its slot or the first empty one in
+        `index`; on a full set, `left` is 0 and `index` is not a free slot."""
+        cur = SScratchVar(TealType.uint64)
         return Seq(
-            Seq([slot.set(arg.load()) for arg, slot in zip(self.args, self.slots)]),
-            self.area.flush() if flush_area else Seq(),
+            self.index.store(self.hash(key.load() - Int(1))),
+            self.found.store(0),
+            self.left.store(Int(self.capacity)),
+            While(self.left.load()).Do(
+                cur.store(self._key_at(self.index.load())),
+                If(cur == key).Then(self.found.store(1), Break()),
+                If(cur == 0).Then(Break()),
+                self.index.store((self.index + 1) % Int(self.capacity)),
+                self.left.dec(),
+            ),
         )
 
+    def _set_key(self, key: Expr):
+        return self.area.replace(
+            fold_mul(self.index, self.slot_size),
+            itob_n(key, self.key_size),
+        )
 
-def Sort(array: BoxArrayBase, size: Wrappable, cmp: Callable[[BoxSlot, BoxSlot], Expr]):
-    return Seq(
-        (swap := SScratchVar(TealType.uint64)).store(1),
-        (ub := SScratchVar(TealType.uint64)).store(size),
-        While(swap.load()).Do(
-            swap.store(0),
-            For((i := SScratchVar()).store(1), i < ub, i.inc()).Do(
-                If(cmp(array[i], array[i - 1])).Then(
-                    (tmp := SScratchVar()).store(array[i].get()),
-                    array[i].set(array[i - 1].get()),
-                    array[i - 1].set(tmp),
-                    swap.inc(),
+    def lookup(self, key: Wrappable):
+        """Whether `key` is there, its slot (or the empty one where it would go) is
+        left in `index`."""
+        return self._lookup(wrap(key))
+
+    contains = lookup
+
+    def insert(self, key: Wrappable):
+        """Add `key` if absent, with a single probe: 1 if it was added, 0 otherwise."""
+        return self._insert(wrap(key))
+
+    def clear(self):
+        return self.area.fill()
+
+
+class BoxHashMap(BoxHashSet):
+    """`BoxHashSet` with a `value_size` bytes uint value per key, 0 when inserted."""
+
+    def __init__(
+        self,
+        allocator: BoxAllocator,
+        capacity: int,
+        key_size: int = 8,
+        value_size: int = 8,
+    ):
+        super().__init__(allocator, capacity, key_size, _value_size=value_size)
+        self.value_size = value_size
+
+    def value(self) -> BoxSlot:
+        """Value slot of the last lookup, or insert."""
+        return BoxSlotCustom(lambda x: itob_n(x, self.value_size), Btoi)(
+            self.area,
+            fold_add(fold_mul(self.index, self.slot_size), self.key_size),
+            self.value_size,
+        )
+
+    def get(self, key: Wrappable, default: Wrappable = 0):
+        return If(self.lookup(key)).Then(self.value().get()).Else(wrap(default))
+
+    def set(self, key: Wrappable, value: Wrappable):
+        return Seq(Pop(self.insert(key)), self.value().set(value))
+
+
+class BoxHeap:
+    """Binary min heap of (key, value) uint pairs, `key_size` and `value_size` bytes.
+
+    `size` is its only state, add it to the `BoxScratchStore` to keep the heap across
+    solve calls. With `max_value`, values must be below it and each one is in the heap
+    at most once, as its position is tracked for `decrease_key`; that needs the area
+    zeroed, as a new box is."""
+
+    def __init__(
+        self,
+        allocator: BoxAllocator,
+        capacity: int,
+        key_size: int = 8,
+        value_size: int = 8,
+        max_value: Optional[int] = None,
+    ):
+        self.capacity = capacity
+        self.key_size = key_size
+        self.value_size = value_size
+        self.slot_size = key_size + value_size
+        self.area = allocator.alloc(self.slot_size * capacity)
+        self.positions = None
+        if max_value is not None:
+            # 1-based, so that 0 is not in the heap
+            pos_size = ((capacity + 1).bit_length() + 7) // 8
+            self.positions = BoxArrayCustom(
+                allocator, pos_size, max_value, lambda x: itob_n(x, pos_size), Btoi
+            )
+        self.size = SScratchVar(TealType.uint64)
+        # The popped pair
+        self.key = SScratchVar(TealType.uint64)
+        self.value = SScratchVar(TealType.uint64)
+
+        @Subroutine(TealType.none)
+        def sift_up(index_: Expr, key_: Expr, entry_: Expr):
+            return Seq(
+                (index := SScratchVar()).store(index_),
+                (key := SScratchVar()).store(key_),
+                (entry := SScratchVar()).store(entry_),
+                (parent := SScratchVar()).store(Int(0)),
+                While(index > 0).Do(
+                    parent.store((index - 1) / Int(2)),
+                    If(self._key_at(parent.load()) <= key.load()).Then(Break()),
+                    self._move(parent.load(), index.load()),
+                    index.store(parent),
+                ),
+                self._put(index.load(), entry.load()),
+            )
+
+        @Subroutine(TealType.none)
+        def sift_down(index_: Expr, key_: Expr, entry_: Expr):
+            return Seq(
+                (index := SScratchVar()).store(index_),
+                (key := SScratchVar()).store(key_),
+                (entry := SScratchVar()).store(entry_),
+                (child := SScratchVar()).store(index * 2 + Int(1)),
+                While(child < self.size).Do(
+                    (child_key := SScratchVar()).store(self._key_at(child.load())),
+                    If(child + Int(1) < self.size.load()).Then(
+                        (tmp := SScratchVar()).store(self._key_at(child + Int(1))),
+                        If(tmp < child_key).Then(child.inc(), child_key.store(tmp)),
+                    ),
+                    If(key <= child_key).Then(Break()),
+                    self._move(child.load(), index.load()),
+                    index.store(child),
+                    child.store(index * 2 + Int(1)),
+                ),
+                self._put(index.load(), entry.load()),
+            )
+
+        self._sift_up = sift_up
+        self._sift_down = sift_down
+
+    def _key_at(self, index: Expr):
+        return Btoi(self.area.extract(fold_mul(index, self.slot_size), self.key_size))
+
+    def _entry_value(self, entry: Expr):
+        return Btoi(Extract(entry, Int(self.key_size), Int(self.value_size)))
+
+    def _put(self, index: Expr, entry: Expr):
+        if self.positions is None:
+            return self.area.replace(fold_mul(index, self.slot_size), entry)
+        return Seq(
+            (tmp := SScratchVar()).store(entry),
+            self.area.replace(fold_mul(index, self.slot_size), tmp.load()),
+            self.positions[self._entry_value(tmp.load())].set(index + Int(1)),
+        )
+
+    def _move(self, src: Expr, dst: Expr):
+        return self._put(
+            dst, self.area.extract(fold_mul(src, self.slot_size), self.slot_size)
+        )
+
+    def init(self):
+        return self.size.store(Int(0))
+
+    def empty(self):
+        return self.size == 0
+
+    def push(self, key: Wrappable, value: Wrappable):
+        return Seq(
+            (tmp := SScratchVar()).store(key),
+            self.size.inc(),
+            self._sift_up(
+                self.size - 1,
+                tmp.load(),
+                Concat(
+                    itob_n(tmp.load(), self.key_size),
+                    itob_n(wrap(value), self.value_size),
+                ),
+            ),
+        )
+
+    def pop(self):
+        """Remove the min pair, storing it into `key` and `value`."""
+        last = SScratchVar()
+        return Seq(
+            (entry := SScratchVar()).store(self.area.extract(0, self.slot_size)),
+            self.key.store(Btoi(Extract(entry.load(), Int(0), Int(self.key_size)))),
+            self.value.store(self._entry_value(entry.load())),
+            self.size.dec(),
+            If(self.size > 0).Then(
+                last.store(
+                    self.area.extract(
+                        fold_mul(self.size, self.slot_size), self.slot_size
+                    )
+                ),
+                self._sift_down(
+                    Int(0),
+                    Btoi(Extract(last.load(), Int(0), Int(self.key_size))),
+                    last.load(),
+                ),
+            ),
+            self.positions[self.value].set(0) if self.positions else Seq(),
+        )
+
+    def decrease_key(self, value: Wrappable, key: Wrappable):
+        """Move `value`, which must be in the heap, up to the lower `key`."""
+        assert self.positions is not None, "decrease_key needs max_value"
+        return Seq(
+            (tmp := SScratchVar()).store(key),
+            (tmp_value := SScratchVar()).store(value),
+            self._sift_up(
+                self.positions[tmp_value].get() - Int(1),
+                tmp.load(),
+                Concat(
+                    itob_n(tmp.load(), self.key_size),
+                    itob_n(tmp_value.load(), self.value_size),
+                ),
+            ),
+        )
+
+    def push_or_decrease(self, key: Wrappable, value: Wrappable):
+        """Push `value`, or lower its key if it's in the heap with an higher one."""
+        assert self.positions is not None, "push_or_decrease needs max_value"
+        return Seq(
+            (tmp := SScratchVar()).store(key),
+            (tmp_value := SScratchVar()).store(value),
+            (pos := SScratchVar()).store(self.positions[tmp_value].get()),
+            If(pos == 0)
+            .Then(self.push(tmp, tmp_value))
+            .ElseIf(tmp < self._key_at(pos - 1))
+            .Then(self.decrease_key(tmp_value, tmp)),
+        )
+
+
+class BoxStack:
+    """Stack of `entry_size` bytes uints in a box area, `capacity` of them at most.
+
+    Its state is kept in the box too: add it to the cached list, `cache` and `flush`
+    load and save it (and the entries, with `cache_area`). Several entries can be
+    pushed or popped at once, with a single box access."""
+
+    STATE = ("size",)
+
+    def __init__(
+        self,
+        allocator: BoxAllocator,
+        entry_size: int,
+        capacity: int,
+        cache_area: bool = False,
+    ):
+        for name in self.STATE:
+            setattr(self, name, SScratchVar(TealType.uint64))
+        self.state = BoxScratchStore(
+            allocator, *[getattr(self, name) for name in self.STATE]
+        )
+        self.entry_size = entry_size
+        self.capacity = capacity
+        self.cache_area = cache_area
+        self.area = allocator.alloc(entry_size * capacity)
+
+    def init(self):
+        return self.state.init()
+
+    def cache(self):
+        return Seq(self.state.cache(), self.area.cache() if self.cache_area else Seq())
+
+    def flush(self):
+        return Seq(self.state.flush(), self.area.flush() if self.cache_area else Seq())
+
+    def empty(self):
+        return self.size == 0
+
+    def _pos(self, index: Wrappable):
+        return index
+
+    def _encode(self, values):
+        return Concat(*[itob_n(wrap(x), self.entry_size) for x in values])
+
+    def _write(self, index: Wrappable, data: Expr, count: int):
+        return self.area.replace(fold_mul(self._pos(index), self.entry_size), data)
+
+    def _read(self, index: Wrappable, count: int):
+        return self.area.extract(
+            fold_mul(self._pos(index), self.entry_size), count * self.entry_size
+        )
+
+    def _decode(self, data: Expr, vars: tuple[ScratchVar]):
+        if len(vars) == 1:
+            return vars[0].store(Btoi(data))
+        return Seq(
+            (tmp := SScratchVar()).store(data),
+            Seq(
+                [
+                    var.store(btoi_at(tmp.load(), i * self.entry_size, self.entry_size))
+                    for i, var in enumerate(vars)
+                ]
+            ),
+        )
+
+    def _check_room(self, count: int):
+        # Past capacity a deque would wrap over its front, and a stack over what follows
+        return Assert(self.size <= Int(self.capacity - count))
+
+    def push(self, *values: Wrappable):
+        return Seq(
+            self._check_room(len(values)),
+            self._write(self.size.load(), self._encode(values), len(values)),
+            self.size.inc(len(values)),
+        )
+
+    def pop(self, *vars: ScratchVar):
+        """Pop `len(vars)` entries into `vars`, in the order they were pushed."""
+        return Seq(
+            self.size.dec(len(vars)),
+            self._decode(self._read(self.size.load(), len(vars)), vars),
+        )
+
+    def top(self):
+        return Btoi(self._read(self.size - 1, 1))
+
+    push_back = push
+    pop_back = pop
+
+
+class BoxDeque(BoxStack):
+    """`BoxStack` that can also push and pop at the front, wrapping around its area.
+
+    Entries start at `head`, so memory is used only for those in the queue."""
+
+    STATE = ("head", "size")
+
+    def _pos(self, index: Wrappable):
+        if isinstance(index, int) and index == 0:
+            return self.head.load()
+        return (self.head + index) % Int(self.capacity)
+
+    def _write(self, index: Wrappable, data: Expr, count: int):
+        if count == 1:
+            return super()._write(index, data, count)
+        pos = SScratchVar(TealType.uint64)
+        cut = SScratchVar(TealType.uint64)
+        return Seq(
+            (tmp := SScratchVar()).store(data),
+            pos.store(self._pos(index)),
+            If(pos + count <= Int(self.capacity))
+            .Then(self.area.replace(pos * self.entry_size, tmp.load()))
+            .Else(
+                cut.store((Int(self.capacity) - pos.load()) * Int(self.entry_size)),
+                self.area.replace(
+                    pos * self.entry_size, Extract(tmp.load(), Int(0), cut.load())
+                ),
+                self.area.replace(0, Suffix(tmp.load(), cut.load())),
+            ),
+        )
+
+    def _read(self, index: Wrappable, count: int):
+        if count == 1:
+            return super()._read(index, count)
+        pos = SScratchVar(TealType.uint64)
+        cut = SScratchVar(TealType.uint64)
+        return Seq(
+            pos.store(self._pos(index)),
+            If(pos + count <= Int(self.capacity))
+            .Then(self.area.extract(pos * self.entry_size, count * self.entry_size))
+            .Else(
+                Seq(
+                    cut.store((Int(self.capacity) - pos.load()) * Int(self.entry_size)),
+                    Concat(
+                        self.area.extract(pos * self.entry_size, cut.load()),
+                        self.area.extract(0, Int(count * self.entry_size) - cut.load()),
+                    ),
                 )
             ),
-        ),
-    )
+        )
+
+    def push_front(self, *values: Wrappable):
+        return Seq(
+            self._check_room(len(values)),
+            self.head.store(
+                (self.head + Int(self.capacity - len(values))) % Int(self.capacity)
+            ),
+            self._write(0, self._encode(values), len(values)),
+            self.size.inc(len(values)),
+        )
+
+    def pop_front(self, *vars: ScratchVar):
+        """Pop `len(vars)` entries into `vars`, from the front one."""
+        return Seq(
+            self._decode(self._read(0, len(vars)), vars),
+            self.head.store((self.head + len(vars)) % Int(self.capacity)),
+            self.size.dec(len(vars)),
+        )
+
+    def front(self):
+        return Btoi(self._read(0, 1))
+
+
+class HeapSort:
+    """In place heap sort of `array[:size]`, `cmp(a, b)` being `a < b`.
+
+    The work is split in `size / 2 + size - 1` steps of a single sift down each, `index`
+    being the next one: keep it with the work state to sort over several solve calls.
+    """
+
+    def __init__(
+        self,
+        array: BoxArrayBase,
+        size: Wrappable,
+        cmp: Callable[[BoxSlot, BoxSlot], Expr],
+        index: ScratchVar,
+    ):
+        self.array = array
+        self.size = size
+        self.index = index
+
+        @Subroutine(TealType.uint64)
+        def less(i: Expr, j: Expr):
+            return cmp(array[i], array[j])
+
+        @Subroutine(TealType.none)
+        def sift_down(root_: Expr, end_: Expr):
+            return Seq(
+                (root := SScratchVar()).store(root_),
+                (end := SScratchVar()).store(end_),
+                (child := SScratchVar()).store(root * 2 + Int(1)),
+                While(child < end).Do(
+                    If(
+                        AndShort(
+                            child + Int(1) < end.load(),
+                            less(child.load(), child + Int(1)),
+                        )
+                    ).Then(child.inc()),
+                    If(Not(less(root.load(), child.load()))).Then(Break()),
+                    self.swap(root, child),
+                    root.store(child),
+                    child.store(root * 2 + Int(1)),
+                ),
+            )
+
+        self.sift_down = sift_down
+
+    def swap(self, i: Wrappable, j: Wrappable):
+        return Seq(
+            (tmp := SScratchVar()).store(self.array[i].get()),
+            self.array[i].set(self.array[j].get()),
+            self.array[j].set(tmp),
+        )
+
+    def init(self):
+        return self.index.store(Int(0))
+
+    def done(self):
+        return self.index.load() + Int(1) >= wrap(self.size) / Int(2) + wrap(self.size)
+
+    def step(self):
+        # Build the max heap bottom up, then move its root to the end of the array
+        heapify = SScratchVar()
+        end = SScratchVar()
+        return Seq(
+            heapify.store(wrap(self.size) / Int(2)),
+            If(self.index.load() < heapify.load())
+            .Then(self.sift_down(heapify - self.index.load() - Int(1), wrap(self.size)))
+            .Else(
+                end.store(
+                    wrap(self.size) + heapify.load() - self.index.load() - Int(1)
+                ),
+                self.swap(0, end),
+                self.sift_down(Int(0), end.load()),
+            ),
+            self.index.store(self.index.load() + Int(1)),
+        )
+
+    def run(self):
+        return Seq(self.init(), While(Not(self.done())).Do(self.step()))
+
+
+def Sort(array: BoxArrayBase, size: Wrappable, cmp: Callable[[BoxSlot, BoxSlot], Expr]):
+    return HeapSort(array, size, cmp, SScratchVar(TealType.uint64)).run()